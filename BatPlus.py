@@ -1,47 +1,175 @@
+import argparse
+import cProfile
 import logging
-import sys
 
+from bat.BandDetector import BandDetector
+from bat.DatabaseHandler import FileIndex
 from bat.DatabaseHandler import SQL3Handler
+from bat.DicomHandler import DicomHandler
 from bat.DirectoryHandler import DirectoryHandler
 from bat.ImageHandler import ImageHandler
+from bat.Pipeline import Pipeline
+from bat.ProfileFilter import Edge_Modes
+from bat.RenderHandler import Renderer
+from bat.ResultCache import ResultCache
+from bat.SeriesHandler import SeriesHandler
+from bat.SliceRules import SliceRules
+from bat.StageTimer import StageTimer
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
-                    datefmt='%a, %d %b %Y %H:%M:%S',
-                    filename=r'./BatPlus.log',
-                    filemode='w')
-# define a stream that will show log level > ERROR on screen also
-console = logging.StreamHandler()
-console.setLevel(logging.WARNING)
-formatter = logging.Formatter('%(levelname)-8s %(message)s')
-console.setFormatter(formatter)
-logging.getLogger('').addHandler(console)
-
-
-def main():
-    if len(sys.argv) == 1:
-        files = DirectoryHandler(r'.\test')
-    elif len(sys.argv) == 2:
-        files = DirectoryHandler(sys.argv[1])
-    else:
-        print("programe paramters confused!")
-        return 1
-    print("Program is finding dicom files...")
-    count = 1
-    for _file in files.Dicom_File_Path:
-        sys.stdout.write(f"\r{count:d}/{files.Total_Dicom_Quantity:d}: ")
-        _image = ImageHandler(_file, window=(70, -5))
-        count += 1
-        if _image.isImageComplete:
-            _image.save_image()
-            if not _image.Kernel != "Hr40f" and \
-                    (_image.OriginalCollimation == 16 or
-                     _image.OriginalCollimation == 1 or
-                     _image.OriginalCollimation == 32):
-                _image.evaluate_iq(100, 2)
-            SQL3Handler(_image).insert_data()
+
+Log_Levels = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+
+def setup_logging(level="DEBUG"):
+    """
+    Configure the logging of the program.
+    It is called by main only, so the worker processes which import this module do not truncate the log file.
+    :param level: the lowest level written into the log file, one of Log_Levels
+    """
+    logging.basicConfig(level=getattr(logging, level),
+                        format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
+                        datefmt='%a, %d %b %Y %H:%M:%S',
+                        filename=r'./BatPlus.log',
+                        filemode='w')
+    # define a stream that will show log level > ERROR on screen also
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    formatter = logging.Formatter('%(levelname)-8s %(message)s')
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Band Assessment image evaluation.")
+    parser.add_argument("directory", nargs="?", default=r'.\test',
+                        help="the folder to search the dicom files")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="the number of worker processes, default 1 runs in the current process")
+    parser.add_argument("--prefetch", type=int, default=16,
+                        help="the number of dicom files read ahead by the reader threads, 0 to disable")
+    parser.add_argument("--prefetch-readers", type=int, default=4,
+                        help="the number of reader threads of the prefetch")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip the unchanged files and the images already stored in database")
+    parser.add_argument("--count", action="store_true",
+                        help="count the files before processing to show the total in progress")
+    parser.add_argument("--series", action="store_true",
+                        help="process whole series as memory-mapped volumes, no image is saved")
+    parser.add_argument("--cache-dir", default=SeriesHandler.Cache_Directory,
+                        help="the folder of the series volume cache")
+    parser.add_argument("--cache-size", type=int, default=SeriesHandler.Max_Size // (1024 * 1024), metavar="MB",
+                        help="the max size of the series volume cache, the least recently used volume is removed")
+    parser.add_argument("--migrate-db", action="store_true",
+                        help="convert the integration results stored as string into BLOB, then exit")
+    parser.add_argument("--refilter", type=int, metavar="WIDTH",
+                        help="apply the median filter of WIDTH again on the stored raw results, then exit")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory map the pixel data of the uncompressed files instead of decoding it")
+    parser.add_argument("--median-edge", default="truncate", choices=Edge_Modes,
+                        help="how the median filter handles the end of the profile")
+    parser.add_argument("--thresholds", type=float, nargs=2, metavar=("WARNING", "ERROR"),
+                        default=(ImageHandler.Warning_Threshold, ImageHandler.Error_Threshold),
+                        help="the HU deviation counted as warning / error by the IQ evaluation")
+    parser.add_argument("--reclassify", action="store_true",
+                        help="classify the stored IQ evaluations again by --thresholds, then exit")
+    parser.add_argument("--rules", metavar="FILE",
+                        help="the json SliceRules file which selects the analyses of each slice by its header")
+    parser.add_argument("--detect-bands", action="store_true",
+                        help="detect ring / band artifacts over all stored profiles into table BandDetections, "
+                             "then exit")
+    parser.add_argument("--band-z", type=float, default=BandDetector.Z_Threshold,
+                        help="the z-score against the fleet history counted as artifact by --detect-bands")
+    parser.add_argument("--render", default="sync", choices=Renderer.Modes,
+                        help="save the images and plots in the current thread, on a background thread, or not at all")
+    parser.add_argument("--no-render", dest="render", action="store_const", const="off",
+                        help="the same as --render off, only the results are stored in database")
+    parser.add_argument("--render-db", metavar="OUTPUT_DIR",
+                        help="plot the integration results stored in database into OUTPUT_DIR, then exit")
+    parser.add_argument("--result-cache", metavar="DIR",
+                        help="reuse the integration and IQ ring results of the same pixel data from DIR")
+    parser.add_argument("--result-cache-size", type=int, default=ResultCache.Max_Size // (1024 * 1024),
+                        metavar="MB", help="the max size of the result cache, the least recently used is removed")
+    parser.add_argument("--timing", action="store_true",
+                        help="measure the time of each processing stage and print a summary at the end")
+    parser.add_argument("--timing-export", metavar="FILE",
+                        help="save the timing summary as csv (*.csv) or json, implies --timing")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="run the processing under cProfile and save the stats into FILE")
+    parser.add_argument("--log-level", default="DEBUG", choices=Log_Levels,
+                        help="the lowest level written into BatPlus.log, the screen always shows WARNING and above")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    setup_logging(args.log_level)
+    if args.migrate_db:
+        print(f"{SQL3Handler.migrate_profiles():d} integration results migrated.")
+        return
+    if args.refilter is not None:
+        print(f"{SQL3Handler.refilter_profiles(args.refilter, args.median_edge):d} profiles filtered again.")
+        return
+    if args.detect_bands:
+        detections = BandDetector(args.band_z).run()
+        print(f"{len(detections):d} ring / band artifacts detected.")
+        return
+    if args.reclassify:
+        updated = SQL3Handler.reclassify_iq(*args.thresholds)
+        print(f"{updated:d} IQ evaluations classified again.")
+        return
+    ImageHandler.Warning_Threshold, ImageHandler.Error_Threshold = args.thresholds
+    ImageHandler.Render = Renderer(args.render)
+    if args.render_db is not None:
+        profiles, metadata = SQL3Handler.query_profiles()
+        ImageHandler.Render.save_profiles(args.render_db, profiles, metadata)
+        ImageHandler.Render.close()
+        print(f"{len(profiles):d} stored results plotted.")
+        return
+    ImageHandler.Median_Edge = args.median_edge
+    DicomHandler.Memory_Map = args.mmap
+    SeriesHandler.Max_Size = args.cache_size * 1024 * 1024
+    if args.result_cache is not None:
+        ImageHandler.Result_Cache = ResultCache(args.result_cache, args.result_cache_size * 1024 * 1024)
+    StageTimer.Enabled = args.timing or args.timing_export is not None
+    profiler = cProfile.Profile() if args.profile is not None else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        process(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+    if StageTimer.Enabled:
+        print("\n" + StageTimer.summary())
+        if args.timing_export is not None:
+            StageTimer.export(args.timing_export)
     print("Program exits sucesfully.")
 
 
+def process(args):
+    """
+    Find the dicom files under the directory, process them and store the results.
+    """
+    index = FileIndex() if args.incremental else None
+    files = DirectoryHandler(args.directory, index=index)
+    print("Program is finding dicom files...")
+    rules = SliceRules.load(args.rules) if args.rules is not None else SliceRules()
+    pipeline = Pipeline(workers=args.workers, index=index, rules=rules)
+    if args.series:
+        pipeline.run_series(SeriesHandler.group_files(files.iter_prefetch(args.prefetch, args.prefetch_readers),
+                                                      args.cache_dir, rules=rules, index=index))
+    else:
+        total = files.estimate_total() if args.count else None
+        # the whole file is only read ahead for the current process,
+        # the worker processes read their files in parallel and memory mapping reads the page cache
+        read_content = args.workers <= 1 and not args.mmap
+        pipeline.run(files.iter_prefetch(args.prefetch, args.prefetch_readers, read_content, rules), total)
+    if pipeline.Rule_Skipped_Quantity:
+        print(f"\n{pipeline.Rule_Skipped_Quantity:d} files skipped by the slice rules.")
+    if index is not None:
+        print(f"\n{files.Skipped_Quantity:d} files skipped as already processed.")
+
+
 if __name__ == '__main__':
     main()
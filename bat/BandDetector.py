@@ -0,0 +1,177 @@
+import logging
+import sqlite3
+import warnings
+
+import numpy as np
+
+from bat.DatabaseHandler import SQL3Handler
+
+
+class BandDetector:
+    """
+    BandDetector finds ring and band artifacts in the stored integration results of the whole fleet at once.
+    The profiles are grouped by scan mode (scanner model, kernel, slice mode, kvp) and by profile length,
+    because the phantom radius in pixels differs with the scanner and the field of view, so the same radius
+    index of two profiles of a different length is not the same ring. For each mode the fleet history gives a
+    baseline (the median profile) and a spread (the scaled median absolute deviation) per radius.
+    Every profile is subtracted by the baseline and divided by the spread into z-scores, then each run of
+    neighbouring radii over Z_Threshold is a detection: a "ring" if it is narrower than Min_Band_Width,
+    otherwise a "band". The detections are written into table BandDetections.
+    """
+    Z_Threshold = 4.0
+    Min_Band_Width = 3
+    # the spread of a radius is at least Min_Sigma HU, so a radius with almost no variation is not over sensitive
+    Min_Sigma = 0.1
+    # a mode with less profiles has no reliable history and is not checked
+    Min_History = 5
+    # 1.4826 * MAD is the standard deviation of a normal distribution
+    Mad_Scale = 1.4826
+    Detection_Dtype = np.dtype([("uid", "U64"),
+                                ("serial_number", "U32"),
+                                ("kernel", "U16"),
+                                ("slice_mode", "U16"),
+                                ("kvp", "f8"),
+                                ("kind", "U8"),
+                                ("start_radius", "i4"),
+                                ("end_radius", "i4"),
+                                ("peak_radius", "i4"),
+                                ("peak_z", "f8"),
+                                ("peak_deviation", "f8")])
+
+    def __init__(self, z_threshold=None, min_band_width=None, database_name=None):
+        """
+        :param z_threshold: the z-score of a detection, None to use Z_Threshold
+        :param min_band_width: the number of radii of a band, None to use Min_Band_Width
+        :param database_name: the sqlite3 database file, None to use SQL3Handler.Database_Name
+        """
+        if z_threshold is not None:
+            self.Z_Threshold = z_threshold
+        if min_band_width is not None:
+            self.Min_Band_Width = min_band_width
+        self.Database_Name = database_name if database_name is not None else SQL3Handler.Database_Name
+
+    def statistics(self, profiles):
+        """
+        :param profiles: a 2-D np array of the profiles of one mode, one per row, padded by nan
+        :return: a tuple of 2 np arrays as (baseline, sigma) per radius
+        """
+        with warnings.catch_warnings():
+            # a radius stored by no profile is all nan
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            baseline = np.nanmedian(profiles, axis=0)
+            sigma = np.nanmedian(np.abs(profiles - baseline), axis=0) * self.Mad_Scale
+        return baseline, np.fmax(sigma, self.Min_Sigma)
+
+    def z_scores(self, profiles):
+        """
+        :param profiles: a 2-D np array of the profiles of one mode
+        :return: a tuple of 2 np arrays in the shape of profiles as (deviation to the baseline, z-score)
+        """
+        baseline, sigma = self.statistics(profiles)
+        deviation = profiles - baseline
+        return deviation, deviation / sigma
+
+    def find_runs(self, z):
+        """
+        Find the runs of neighbouring radii whose absolute z-score is over Z_Threshold.
+        :param z: a 2-D np array of z-scores
+        :return: 3 np arrays of the same length as (row, start radius, end radius exclusive)
+        """
+        flags = np.abs(np.nan_to_num(z)) >= self.Z_Threshold
+        edges = np.diff(np.pad(flags, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+        # both are in row major order, so the n-th start and the n-th end belong to the same run
+        starts = np.argwhere(edges == 1)
+        ends = np.argwhere(edges == -1)
+        return starts[:, 0], starts[:, 1], ends[:, 1]
+
+    def detect(self, profiles, metadata, serial_number=None):
+        """
+        :param profiles: a 2-D np array, e.g. from SQL3Handler.query_profiles
+        :param metadata: the structured np array in SQL3Handler.Metadata_Dtype of the profiles
+        :param serial_number: only report the detections of these scanners (one value or a list),
+        the profiles of the other scanners are still used as history. None to report all.
+        :return: a structured np array in Detection_Dtype
+        """
+        detections = []
+        if len(metadata) == 0:
+            return np.array(detections, dtype=self.Detection_Dtype)
+        reported = np.ones(len(metadata), dtype=bool)
+        if serial_number is not None:
+            reported = np.isin(metadata["serial_number"], np.atleast_1d(serial_number).astype(str))
+        keys = np.empty(len(metadata), dtype=[("modality", metadata.dtype["modality"]),
+                                              ("kernel", metadata.dtype["kernel"]),
+                                              ("slice_mode", metadata.dtype["slice_mode"]),
+                                              ("kvp", "f8"),
+                                              ("length", "i8")])
+        for field in ("modality", "kernel", "slice_mode", "kvp"):
+            keys[field] = metadata[field]
+        # the profiles are padded by nan to the longest one
+        keys["length"] = np.count_nonzero(~np.isnan(profiles), axis=1)
+        modes, inverse = np.unique(keys, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        for index, mode in enumerate(modes):
+            rows = np.flatnonzero(inverse == index)
+            if len(rows) < self.Min_History:
+                logging.info(r"Mode %s has only %d profiles, not checked.", mode, len(rows))
+                continue
+            deviation, z = self.z_scores(profiles[rows])
+            for row, start, end in zip(*self.find_runs(z)):
+                if not reported[rows[row]]:
+                    continue
+                peak = start + int(np.argmax(np.abs(z[row, start:end])))
+                record = metadata[rows[row]]
+                detections.append((record["uid"], record["serial_number"], record["kernel"], record["slice_mode"],
+                                   record["kvp"], "band" if end - start >= self.Min_Band_Width else "ring",
+                                   start, end - 1, peak, z[row, peak], deviation[row, peak]))
+        return np.array(detections, dtype=self.Detection_Dtype)
+
+    @staticmethod
+    def create_table(con):
+        """
+        Create the table BandDetections if it is not existing.
+        :param con: the sqlite3 connection
+        """
+        con.execute('''create table if not exists BandDetections(
+                           uid text,
+                           serial_number text,
+                           kernel text,
+                           slice_mode text,
+                           kvp real,
+                           kind text,
+                           start_radius integer,
+                           end_radius integer,
+                           peak_radius integer,
+                           peak_z real,
+                           peak_deviation real,
+                           z_threshold real);''')
+        con.execute(r"create index if not exists BandDetections_Uid on BandDetections(uid);")
+
+    def run(self, serial_number=None, kernel=None, kvp=None, slice_mode=None, date_from=None, date_to=None):
+        """
+        Detect over the stored profiles and replace the old detections of the checked records.
+        The filters are the same as SQL3Handler.query_profiles, except serial_number only selects the reported
+        scanners while the whole fleet of the selected modes is the history.
+        :return: a structured np array in Detection_Dtype
+        """
+        profiles, metadata = SQL3Handler.query_profiles(kernel=kernel, kvp=kvp, slice_mode=slice_mode,
+                                                        date_from=date_from, date_to=date_to,
+                                                        database_name=self.Database_Name)
+        detections = self.detect(profiles, metadata, serial_number)
+        checked = metadata["uid"]
+        if serial_number is not None:
+            checked = checked[np.isin(metadata["serial_number"], np.atleast_1d(serial_number).astype(str))]
+        con = sqlite3.connect(self.Database_Name)
+        try:
+            self.create_table(con)
+            with con:
+                con.executemany(r"delete from BandDetections where uid = ?;", ((str(uid),) for uid in checked))
+                con.executemany(r"insert into BandDetections values (?,?,?,?,?,?,?,?,?,?,?,?);",
+                                (tuple(d.item()) + (self.Z_Threshold,) for d in detections))
+        finally:
+            con.close()
+        logging.info(r"%d profiles checked, %d detections.", len(checked), len(detections))
+        return detections
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
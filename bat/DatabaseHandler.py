@@ -1,19 +1,55 @@
 import sqlite3
 import logging
+import os
+import threading
+import time
+import typing
 import numpy as np
-from bat.ImageHandler import ImageHandler
+from bat.IqResult import IqResult
+from bat.ProfileFilter import median_filter
+from bat.StageTimer import StageTimer
+
+if typing.TYPE_CHECKING:
+    # only for the type hint, importing ImageHandler at run time loads the whole image stack
+    from bat.ImageHandler import ImageHandler
 
 
 class SQL3Handler:
     """
     Create a Sqlite3 handler to store the data.
-    for the integration result, it will be converted to string and then store into database.
-    So when extracting data, the string should be converted back to list or numpy array before doing calculation
+    for the integration result, it is stored as a BLOB of raw float values behind an 8 bytes header:
+    b"BAT" + format version + numpy dtype string padded to 4 bytes, e.g. b"BAT\x01<f8\x00".
+    Old records store it as a comma joined string, decode_profile reads both formats
+    and migrate_profiles converts the old records in place.
+    The IqResult of an image is stored in table IqEvaluations with the same uid, the ring in the same BLOB format.
     """
     Integration_Split = ','
     Database_Name = "BandAssessment.sqlite3.db"
+    Profile_Magic = b"BAT"
+    Profile_Version = 1
+    Profile_Header_Size = 8
+    # "<f8" keeps the value exactly, "<f4" halves the size
+    Profile_Dtype = "<f8"
+    # the columns written by record_values, in the same order
+    Columns = ("uid", "modality", "serial_number", "kvp", "current", "kernel", "total_collimation",
+               "slice_thickness", "slice_mode", "instance", "integration_result", "comment",
+               "date_time", "raw_result")
+    # the columns written by iq_values, in the same order
+    Iq_Columns = ("uid", "min_hu", "min_row", "min_col", "max_hu", "max_deviation", "max_dev_row", "max_dev_col",
+                  "warning_threshold", "error_threshold", "ring_count", "warning_count", "error_count",
+                  "warning_rate", "error_rate", "ring")
+    # the metadata returned by query_profiles
+    Metadata_Dtype = np.dtype([("uid", "U64"),
+                               ("modality", "U64"),
+                               ("serial_number", "U32"),
+                               ("kvp", "f8"),
+                               ("current", "f8"),
+                               ("kernel", "U16"),
+                               ("slice_mode", "U16"),
+                               ("instance", "i8"),
+                               ("date_time", "U32")])
 
-    def __init__(self, dicom_image: ImageHandler):
+    def __init__(self, dicom_image: "ImageHandler"):
         self.DicomImage = dicom_image
         logging.debug(r"Run into SQL3Handler")
         try:
@@ -22,8 +58,23 @@ class SQL3Handler:
             logging.debug(str(e))
             return
         logging.debug(r"Database connected")
+        try:
+            self.ensure_schema(con)
+        except sqlite3.Error as e:
+            logging.debug(str(e))
+            return
+        finally:
+            con.close()
+        logging.debug(r"create table done.")
+
+    @staticmethod
+    def create_table(con):
+        """
+        Create the table BandAssessments if it is not existing.
+        :param con: the sqlite3 connection
+        """
         sql_cursor = con.cursor()
-        sql_string = '''create table BandAssessments(
+        sql_string = '''create table if not exists BandAssessments(
                            uid text primary key,
                            modality text,
                            serial_number integer,
@@ -35,14 +86,175 @@ class SQL3Handler:
                            slice_mode text,
                            instance integer,
                            integration_result text,
-                           comment text);'''
+                           comment text,
+                           date_time text,
+                           raw_result blob);'''
+        sql_cursor.execute(sql_string)
+        sql_string = '''create table if not exists IqEvaluations(
+                           uid text primary key,
+                           min_hu real,
+                           min_row integer,
+                           min_col integer,
+                           max_hu real,
+                           max_deviation real,
+                           max_dev_row integer,
+                           max_dev_col integer,
+                           warning_threshold real,
+                           error_threshold real,
+                           ring_count integer,
+                           warning_count integer,
+                           error_count integer,
+                           warning_rate real,
+                           error_rate real,
+                           ring blob);'''
+        sql_cursor.execute(sql_string)
+
+    @classmethod
+    def ensure_schema(cls, con):
+        """
+        Create the tables BandAssessments and IqEvaluations if they are not existing, and upgrade the table created by an old version:
+        add the column date_time, fill it from the uid (SerialNumber + DateTime + Instance),
+        add the column raw_result for the integration result before median filter,
+        and create the indexes used by query_profiles.
+        :param con: the sqlite3 connection
+        """
+        cls.create_table(con)
+        columns = [row[1] for row in con.execute(r"pragma table_info(BandAssessments);")]
+        if "date_time" not in columns:
+            con.execute(r"alter table BandAssessments add column date_time text;")
+            con.execute(r"update BandAssessments set date_time = "
+                        r"substr(uid, length(cast(serial_number as text)) + 1, 14) where date_time is null;")
+            logging.info(r"Column date_time added to BandAssessments.")
+        if "raw_result" not in columns:
+            con.execute(r"alter table BandAssessments add column raw_result blob;")
+            logging.info(r"Column raw_result added to BandAssessments.")
+        con.execute(r"create index if not exists BandAssessments_Mode on "
+                    r"BandAssessments(serial_number, kernel, slice_mode);")
+        con.execute(r"create index if not exists BandAssessments_DateTime on BandAssessments(date_time);")
+        con.commit()
+
+    @classmethod
+    def insert_statement(cls, conflict=r"insert"):
+        """
+        :param conflict: the insert statement, e.g. "insert", "insert or ignore"
+        :return: the sql string to insert the values of record_values
+        """
+        return conflict + r" into BandAssessments (" + ",".join(cls.Columns) + r") values (" + \
+            ",".join("?" * len(cls.Columns)) + r");"
+
+    @classmethod
+    def iq_insert_statement(cls, conflict=r"insert"):
+        """
+        :param conflict: the insert statement, e.g. "insert", "insert or ignore"
+        :return: the sql string to insert the values of iq_values
+        """
+        return conflict + r" into IqEvaluations (" + ",".join(cls.Iq_Columns) + r") values (" + \
+            ",".join("?" * len(cls.Iq_Columns)) + r");"
+
+    @classmethod
+    def iq_values(cls, uid, iq_result):
+        """
+        Convert an IqResult into the values of one row of IqEvaluations.
+        :param uid: the uid of the image
+        :param iq_result: an IqResult
+        :return: a tuple of the column values
+        """
+        record = iq_result.as_dict()
+        return (uid,
+                record["min_hu"],
+                record["min_pos"][0],
+                record["min_pos"][1],
+                record["max_hu"],
+                record["max_deviation"],
+                record["max_dev_position"][0],
+                record["max_dev_position"][1],
+                record["warning_threshold"],
+                record["error_threshold"],
+                record["ring_count"],
+                record["warning_count"],
+                record["error_count"],
+                record["warning_rate"],
+                record["error_rate"],
+                cls.encode_profile(iq_result.Ring))
+
+    @classmethod
+    def record_values(cls, dicom_image):
+        """
+        Convert an image into the values of one row of BandAssessments.
+        :param dicom_image: an ImageHandler or any object with the same attributes, e.g. Pipeline.ImageResult
+        :return: a tuple of the column values
+        """
+        metadata = dicom_image.Metadata
+        return (metadata.Uid,
+                metadata.Modality,
+                metadata.SerialNumber,
+                metadata.KVP,
+                metadata.Current,
+                metadata.Kernel,
+                metadata.TotalCollimation,
+                metadata.SliceThickness,
+                metadata.SliceMode,
+                metadata.Instance,
+                cls.encode_profile(dicom_image.Image_Median_Filter_Result),
+                "n.a.",
+                metadata.DateTime,
+                cls.encode_profile(dicom_image.Image_Integration_Result))
+
+    @classmethod
+    def encode_profile(cls, profile, dtype=None):
+        """
+        Convert an integration result into the BLOB to store in sqlite3.
+        :param profile: a 1-D array like of float
+        :param dtype: "<f8" or "<f4", None to use Profile_Dtype
+        :return: the bytes of header + raw values
+        """
+        dtype = np.dtype(dtype if dtype is not None else cls.Profile_Dtype)
+        header = cls.Profile_Magic + bytes((cls.Profile_Version,)) + dtype.str.encode("ascii").ljust(4, b"\x00")
+        return header + np.ascontiguousarray(profile, dtype=dtype).tobytes()
+
+    @classmethod
+    def decode_profile(cls, value):
+        """
+        Convert a stored integration result back to a np array. Both the BLOB and the old string format are read.
+        The BLOB is not copied, the returned array is a read-only view of it.
+        :param value: the integration_result value of one row
+        :return: a 1-D np array
+        """
+        if isinstance(value, str):
+            return np.array([float(x) for x in value.split(cls.Integration_Split)])
+        if value[:3] != cls.Profile_Magic:
+            raise ValueError("Unknown integration result format.")
+        if value[3] != cls.Profile_Version:
+            raise ValueError("Unknown integration result version: " + str(value[3]))
+        dtype = np.dtype(bytes(value[4:cls.Profile_Header_Size]).rstrip(b"\x00").decode("ascii"))
+        return np.frombuffer(value, dtype=dtype, offset=cls.Profile_Header_Size)
+
+    @classmethod
+    def migrate_profiles(cls, database_name=None, dtype=None, batch_size=1000):
+        """
+        Convert the integration results stored as string into BLOB in place.
+        :param database_name: the sqlite3 database file, None to use Database_Name
+        :param dtype: "<f8" or "<f4", None to use Profile_Dtype
+        :param batch_size: the number of rows converted in one transaction
+        :return: the number of converted rows
+        """
+        con = sqlite3.connect(database_name if database_name is not None else cls.Database_Name)
+        converted = 0
         try:
-            sql_cursor.execute(sql_string)
-        except sqlite3.Error as e:
-            logging.debug(str(e))
-            return
-        logging.debug(r"create table done.")
-        con.close()
+            while True:
+                rows = con.execute(r"select rowid, integration_result from BandAssessments "
+                                   r"where typeof(integration_result) = 'text' limit ?;", (batch_size,)).fetchall()
+                if not rows:
+                    break
+                with con:
+                    con.executemany(r"update BandAssessments set integration_result = ? where rowid = ?;",
+                                    [(cls.encode_profile(cls.decode_profile(value), dtype), rowid)
+                                     for rowid, value in rows])
+                converted += len(rows)
+                logging.info(str(converted) + r" integration results migrated.")
+        finally:
+            con.close()
+        return converted
 
     def insert_data(self):
         try:
@@ -50,29 +262,12 @@ class SQL3Handler:
         except sqlite3.Error as e:
             logging.debug(str(e))
             return
-        # convert numpy into string to store in sqlite3
-        integration_result = []
-        for x in self.DicomImage.Image_Median_Filter_Result:
-            integration_result.append(str(x))
-        int_result_string = self.Integration_Split.join(integration_result)
         # set up for store in sql
         sql_cursor = con.cursor()
-        sql_string = r"insert into BandAssessments values (?,?,?,?,?,?,?,?,?,?,?,?);"
+        sql_string = self.insert_statement()
         try:
             logging.debug(str(self.DicomImage.Uid))
-            sql_cursor.execute(sql_string,
-                               (self.DicomImage.Uid,
-                                self.DicomImage.Modality,
-                                self.DicomImage.SerialNumber,
-                                self.DicomImage.KVP,
-                                self.DicomImage.Current,
-                                self.DicomImage.Kernel,
-                                self.DicomImage.TotalCollimation,
-                                self.DicomImage.SliceThickness,
-                                str(self.DicomImage.TotalSlice) + "x" + str(self.DicomImage.SliceThickness),
-                                self.DicomImage.Instance,
-                                int_result_string,
-                                "n.a."))
+            sql_cursor.execute(sql_string, self.record_values(self.DicomImage))
         except sqlite3.Error as e:
             logging.error(str(e))
             con.close()
@@ -81,23 +276,485 @@ class SQL3Handler:
         logging.info(r"Insert record done.")
         con.close()
 
+    @classmethod
+    def insert_many(cls, dicom_images):
+        """
+        Insert a batch of images with one connection and one commit.
+        A row with an already stored uid is rejected and logged, same as insert_data.
+        :param dicom_images: a list of ImageHandler or Pipeline.ImageResult
+        :return: the number of inserted rows
+        """
+        if not dicom_images:
+            return 0
+        try:
+            with SQL3Writer(cls.Database_Name, conflict="error", batch_size=len(dicom_images)) as writer:
+                writer.write_many(dicom_images)
+        except sqlite3.Error as e:
+            logging.debug(str(e))
+            return 0
+        return writer.Inserted_Quantity
+
     def read_data(self):
+        """
+        Read the stored integration result of the image.
+        :return: a np array, None if the image is not stored
+        """
         try:
             con = sqlite3.connect(self.Database_Name)
         except sqlite3.Error as e:
             logging.debug(str(e))
             return
-        sql_cursor = con.cursor()
-        sql_string = r"select integration_result from BandAssessment"
-        sql_cursor.execute(sql_string)
-        data = sql_cursor.fetchone()[0]
-        str_result = data.split(self.Integration_Split)
-        float_result = []
-        for x in str_result:
-            float_result.append(float(x))
-        np_result = np.array(float_result)
-        print(type(np_result))
-        print(np_result)
-        con.close()
-        # End of class SQL3Handler:
-        ##############################################################
+        try:
+            sql_cursor = con.cursor()
+            sql_string = r"select integration_result from BandAssessments where uid = ?;"
+            sql_cursor.execute(sql_string, (self.DicomImage.Uid,))
+            data = sql_cursor.fetchone()
+        finally:
+            con.close()
+        if data is None:
+            return None
+        return self.decode_profile(data[0])
+
+    @classmethod
+    def query_profiles(cls, serial_number=None, kernel=None, kvp=None, slice_mode=None,
+                       date_from=None, date_to=None, database_name=None, chunk_size=1000, raw=False, modality=None):
+        """
+        Read the integration results of all matched records.
+        Each filter is a single value or a list of values, None to not filter.
+        :param serial_number: the scanner serial number
+        :param kernel: the recon kernel, e.g. "Hr40f"
+        :param kvp: the tube voltage
+        :param slice_mode: the slice mode, e.g. "32x0.6"
+        :param date_from: the earliest DateTime included, as a string prefix e.g. "20170101"
+        :param date_to: the latest DateTime included, as a string prefix e.g. "20171231"
+        :param database_name: the sqlite3 database file, None to use Database_Name
+        :param chunk_size: the number of rows fetched at once
+        :param raw: True to read the integration result before median filter, the old records without it are skipped
+        :param modality: the scanner model, e.g. "SOMATOM Definition AS+"
+        :return: a tuple as (profiles, metadata). profiles is a 2-D np array with one row per record,
+        the shorter profiles are padded by nan. metadata is a structured np array in Metadata_Dtype.
+        """
+        conditions = []
+        parameters = []
+        for column, value in (("serial_number", serial_number), ("kernel", kernel),
+                              ("kvp", kvp), ("slice_mode", slice_mode), ("modality", modality)):
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set, np.ndarray)):
+                value = list(value)
+                conditions.append(column + r" in (" + ",".join("?" * len(value)) + r")")
+                parameters.extend(value)
+            else:
+                conditions.append(column + r" = ?")
+                parameters.append(value)
+        if date_from is not None:
+            conditions.append(r"date_time >= ?")
+            parameters.append(str(date_from))
+        if date_to is not None:
+            # compare as prefix, so "20171231" includes the whole day
+            conditions.append(r"substr(date_time, 1, ?) <= ?")
+            parameters.extend((len(str(date_to)), str(date_to)))
+        if raw:
+            conditions.append(r"raw_result is not null")
+        sql_string = r"select uid, modality, serial_number, kvp, current, kernel, slice_mode, instance, date_time, " + \
+                     (r"raw_result" if raw else r"integration_result") + r" from BandAssessments"
+        if conditions:
+            sql_string += r" where " + r" and ".join(conditions)
+        sql_string += r" order by serial_number, date_time, instance;"
+
+        con = sqlite3.connect(database_name if database_name is not None else cls.Database_Name)
+        metadata = []
+        profiles = []
+        try:
+            cls.ensure_schema(con)
+            sql_cursor = con.execute(sql_string, parameters)
+            while True:
+                rows = sql_cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    metadata.append(tuple(default if value is None else value for value, default in
+                                          zip(row[:9], ("", "", "", np.nan, np.nan, "", "", -1, ""))))
+                    profiles.append(cls.decode_profile(row[9]))
+        finally:
+            con.close()
+        length = max((len(profile) for profile in profiles), default=0)
+        result = np.full((len(profiles), length), np.nan)
+        for index, profile in enumerate(profiles):
+            result[index, :len(profile)] = profile
+        return result, np.array(metadata, dtype=cls.Metadata_Dtype)
+
+    @classmethod
+    def refilter_profiles(cls, width=8, edge="truncate", database_name=None, batch_size=1000):
+        """
+        Apply the median filter again on the stored raw results and overwrite integration_result,
+        e.g. after Median_Width is changed. No image is processed again.
+        The old records without raw_result are not changed.
+        :param width: the width of the median window
+        :param edge: the edge mode of ProfileFilter.median_filter
+        :param database_name: the sqlite3 database file, None to use Database_Name
+        :param batch_size: the number of rows filtered and updated at once
+        :return: the number of updated rows
+        """
+        con = sqlite3.connect(database_name if database_name is not None else cls.Database_Name)
+        updated = 0
+        try:
+            cls.ensure_schema(con)
+            last_rowid = -1
+            while True:
+                rows = con.execute(r"select rowid, raw_result from BandAssessments "
+                                   r"where raw_result is not null and rowid > ? order by rowid limit ?;",
+                                   (last_rowid, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                # filter the profiles of the same length as one stack
+                groups = {}
+                for rowid, value in rows:
+                    profile = cls.decode_profile(value)
+                    groups.setdefault(len(profile), []).append((rowid, profile))
+                values = []
+                for group in groups.values():
+                    filtered = median_filter(np.stack([profile for _, profile in group]), width, edge)
+                    values.extend((cls.encode_profile(profile), rowid) for (rowid, _), profile in zip(group, filtered))
+                with con:
+                    con.executemany(r"update BandAssessments set integration_result = ? where rowid = ?;", values)
+                updated += len(values)
+                logging.info(str(updated) + r" profiles filtered again.")
+        finally:
+            con.close()
+        return updated
+
+    @classmethod
+    def reclassify_iq(cls, warning_threshold, error_threshold, database_name=None, batch_size=1000):
+        """
+        Classify the stored rings of IqEvaluations again by new thresholds and update the counts and rates.
+        The rings of each batch are classified at once, no image is processed again.
+        :param warning_threshold: the deviation counted as warning
+        :param error_threshold: the deviation counted as error
+        :param database_name: the sqlite3 database file, None to use Database_Name
+        :param batch_size: the number of rows classified and updated at once
+        :return: the number of updated rows
+        """
+        con = sqlite3.connect(database_name if database_name is not None else cls.Database_Name)
+        updated = 0
+        try:
+            cls.ensure_schema(con)
+            last_rowid = -1
+            while True:
+                rows = con.execute(r"select rowid, ring from IqEvaluations where rowid > ? order by rowid limit ?;",
+                                   (last_rowid, batch_size)).fetchall()
+                if not rows:
+                    break
+                last_rowid = rows[-1][0]
+                rings = [cls.decode_profile(value) for _, value in rows]
+                stack = np.full((len(rings), max(len(ring) for ring in rings)), np.nan)
+                for index, ring in enumerate(rings):
+                    stack[index, :len(ring)] = ring
+                counts = IqResult.classify(stack, warning_threshold, error_threshold)
+                values = [(warning_threshold, error_threshold, int(ring_count), int(warning_count), int(error_count),
+                           float(warning_rate), float(error_rate), rowid)
+                          for (rowid, _), ring_count, warning_count, error_count, warning_rate, error_rate
+                          in zip(rows, *counts)]
+                with con:
+                    con.executemany(r"update IqEvaluations set warning_threshold = ?, error_threshold = ?, "
+                                    r"ring_count = ?, warning_count = ?, error_count = ?, "
+                                    r"warning_rate = ?, error_rate = ? where rowid = ?;", values)
+                updated += len(values)
+                logging.info(r"%d IQ evaluations classified again.", updated)
+        finally:
+            con.close()
+        return updated
+
+
+class SQL3Writer:
+    """
+    SQL3Writer is a long-lived writer of table BandAssessments with one connection in WAL journal mode.
+    The rows are buffered and written by executemany, committed every Batch_Size rows or Commit_Interval seconds.
+    The interval is kept by a timer thread, so the buffered rows are committed even if no more row comes.
+    The IqResult of an image, if any, is written into IqEvaluations in the same transaction.
+    Use it as a context manager so the last rows are committed and the connection is closed:
+        with SQL3Writer() as writer:
+            writer.write(image)
+    """
+    Batch_Size = 256
+    Commit_Interval = 5.0
+    # how to deal with a row whose uid is already stored
+    Conflict_Statements = {"error": r"insert",
+                           "ignore": r"insert or ignore",
+                           "replace": r"insert or replace"}
+
+    def __init__(self, database_name=None, conflict="ignore", batch_size=None, commit_interval=None,
+                 on_commit=None):
+        """
+        :param database_name: the sqlite3 database file, None to use SQL3Handler.Database_Name
+        :param conflict: "error" to reject, "ignore" to keep the stored row, "replace" to overwrite the stored row
+        :param batch_size: commit every batch_size rows, None to use the class default
+        :param commit_interval: commit if the oldest buffered row is older than commit_interval seconds
+        :param on_commit: a callable called with the list of committed uids, e.g. FileIndex.add_uids
+        """
+        if conflict not in self.Conflict_Statements:
+            raise ValueError("Unknown conflict mode: " + str(conflict))
+        self.Database_Name = database_name if database_name is not None else SQL3Handler.Database_Name
+        self.Conflict = conflict
+        if batch_size is not None:
+            self.Batch_Size = batch_size
+        if commit_interval is not None:
+            self.Commit_Interval = commit_interval
+        self.On_Commit = on_commit
+        self.Inserted_Quantity = 0
+        self._sql_string = SQL3Handler.insert_statement(self.Conflict_Statements[conflict])
+        self._iq_sql_string = SQL3Handler.iq_insert_statement(self.Conflict_Statements[conflict])
+        self._rows = []
+        self._first_row_time = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._con = None
+
+    def open(self):
+        if self._con is not None:
+            return self
+        con = sqlite3.connect(self.Database_Name, check_same_thread=False)
+        try:
+            con.execute(r"pragma journal_mode=wal;")
+            con.execute(r"pragma synchronous=normal;")
+            SQL3Handler.ensure_schema(con)
+        except sqlite3.Error:
+            # opened again by the next flush
+            con.close()
+            raise
+        self._con = con
+        logging.debug(r"Database writer opened: " + str(self.Database_Name))
+        return self
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def write(self, dicom_image):
+        """
+        Buffer one image, the buffer is committed if it is full or too old.
+        :param dicom_image: an ImageHandler or any object with the same attributes, e.g. Pipeline.ImageResult
+        """
+        values = SQL3Handler.record_values(dicom_image)
+        iq_result = getattr(dicom_image, "IqResult", None)
+        iq_values = SQL3Handler.iq_values(values[0], iq_result) if iq_result is not None else None
+        with self._lock:
+            if not self._rows:
+                self._first_row_time = time.monotonic()
+                self._start_timer()
+            self._rows.append((values, iq_values))
+            if len(self._rows) >= self.Batch_Size or \
+                    time.monotonic() - self._first_row_time >= self.Commit_Interval:
+                self._flush()
+
+    def _start_timer(self):
+        timer = threading.Timer(self.Commit_Interval, self._on_timer)
+        timer.daemon = True
+        # the timer is passed to itself, so a timer which fired after being replaced does nothing
+        timer.args = (timer,)
+        self._timer = timer
+        timer.start()
+
+    def _on_timer(self, timer):
+        with self._lock:
+            if self._timer is not timer:
+                return
+            try:
+                self._flush()
+            except Exception as e:
+                # e.g. On_Commit failed, the timer thread must not die with it
+                logging.error(r"Timed commit failed: %s", e)
+
+    def write_many(self, dicom_images):
+        for image in dicom_images:
+            self.write(image)
+
+    def flush(self):
+        """
+        Commit all buffered rows.
+        :return: the number of inserted rows
+        """
+        with self._lock:
+            return self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._rows:
+            return 0
+        rows = self._rows
+        self._rows = []
+        committed = rows
+        with StageTimer.measure("db_insert"):
+            try:
+                self.open()
+                before = self._con.total_changes
+                with self._con:
+                    self._con.executemany(self._sql_string, [values for values, _ in rows])
+                    # count the rows of BandAssessments only
+                    inserted = self._con.total_changes - before
+                    self._con.executemany(self._iq_sql_string, [iq for _, iq in rows if iq is not None])
+            except sqlite3.IntegrityError as e:
+                # only "error" mode can get here, insert one by one to reject only the conflicted rows
+                logging.debug(r"Batch insert failed, insert one by one: %s", e)
+                committed = []
+                for values, iq_values in rows:
+                    try:
+                        with self._con:
+                            self._con.execute(self._sql_string, values)
+                            if iq_values is not None:
+                                self._con.execute(self._iq_sql_string, iq_values)
+                        committed.append((values, iq_values))
+                    except sqlite3.Error as e:
+                        logging.error(r"%s: %s", values[0], e)
+                inserted = len(committed)
+            except sqlite3.Error as e:
+                # e.g. the database is locked or the disk is full, the transaction is rolled back.
+                # The rows are lost but the writer goes on, their files are not indexed by On_Commit,
+                # so an incremental run processes them again.
+                logging.error(r"%d records not inserted: %s", len(rows), e)
+                logging.error(r"Not inserted uids: %s", ", ".join(str(values[0]) for values, _ in rows))
+                return 0
+        self.Inserted_Quantity += inserted
+        logging.info(r"%d records inserted.", inserted)
+        if self.On_Commit is not None:
+            self.On_Commit([values[0] for values, _ in committed])
+        return inserted
+
+    def close(self):
+        with self._lock:
+            try:
+                self._flush()
+            finally:
+                if self._con is not None:
+                    self._con.close()
+                    self._con = None
+
+
+class FileIndex:
+    """
+    FileIndex keeps what has been ingested into the database, so an incremental run only processes new data.
+    1) the uid of every stored record, loaded once from BandAssessments.
+    2) the (path, size, mtime) of every checked file in table FileIndex, an unchanged file is skipped without opening.
+    A Band Assessment file is only written into FileIndex after its uid is stored,
+    so a file failed in processing is tried again next time.
+    """
+    Flush_Size = 1000
+
+    def __init__(self, database_name=None):
+        """
+        :param database_name: the sqlite3 database file, None to use SQL3Handler.Database_Name
+        """
+        self.Database_Name = database_name if database_name is not None else SQL3Handler.Database_Name
+        self.Known_Uids = set()
+        self.Known_Files = {}
+        self._pending = {}
+        self._ready = []
+        # the files are added by the discovery thread while the uids are added by the writer
+        self._lock = threading.RLock()
+        con = sqlite3.connect(self.Database_Name)
+        try:
+            con.execute('''create table if not exists FileIndex(
+                               path text primary key,
+                               size integer,
+                               mtime integer,
+                               uid text);''')
+            for path, size, mtime in con.execute(r"select path, size, mtime from FileIndex"):
+                self.Known_Files[path] = (size, mtime)
+            try:
+                self.Known_Uids.update(uid for uid, in con.execute(r"select uid from BandAssessments"))
+            except sqlite3.Error as e:
+                logging.debug(str(e))
+            con.commit()
+        finally:
+            con.close()
+        logging.info(str(len(self.Known_Files)) + r" indexed files, " +
+                     str(len(self.Known_Uids)) + r" stored uids loaded.")
+
+    @staticmethod
+    def file_stat(full_path, stat_result=None):
+        """
+        :param full_path: the full path of the file
+        :param stat_result: the os.stat_result if already known, e.g. from os.DirEntry.stat()
+        :return: (size, mtime in ns) of the file
+        """
+        if stat_result is None:
+            stat_result = os.stat(full_path)
+        return stat_result.st_size, stat_result.st_mtime_ns
+
+    def is_known_file(self, full_path, stat):
+        """
+        :param full_path: the full path of the file
+        :param stat: (size, mtime) from file_stat
+        :return: True if the file is indexed and not changed since
+        """
+        return self.Known_Files.get(full_path) == tuple(stat)
+
+    def is_known_uid(self, uid):
+        return uid in self.Known_Uids
+
+    def add_file(self, full_path, stat, uid=None):
+        """
+        Record a checked file.
+        :param full_path: the full path of the file
+        :param stat: (size, mtime) from file_stat
+        :param uid: the uid of a Band Assessment file, None for the other files
+        """
+        with self._lock:
+            if uid is None or uid in self.Known_Uids:
+                self._ready.append((full_path, stat[0], stat[1], uid))
+                self.Known_Files[full_path] = tuple(stat)
+                if len(self._ready) >= self.Flush_Size:
+                    self.flush()
+            else:
+                self._pending[full_path] = (stat, uid)
+
+    def mark_checked(self, full_path):
+        """
+        Index a pending Band Assessment file which is not going to be stored, e.g. skipped by the SliceRules,
+        so it is not opened again next time.
+        :param full_path: the full path of the file recorded by add_file
+        """
+        with self._lock:
+            pending = self._pending.pop(full_path, None)
+            if pending is None:
+                return
+            stat, uid = pending
+            self._ready.append((full_path, stat[0], stat[1], uid))
+            self.Known_Files[full_path] = tuple(stat)
+            if len(self._ready) >= self.Flush_Size:
+                self.flush()
+
+    def add_uids(self, uids):
+        """
+        Mark the uids as stored in database, the pending files with these uids are indexed.
+        :param uids: an iterable of uid
+        """
+        with self._lock:
+            self.Known_Uids.update(uids)
+            for full_path, (stat, uid) in list(self._pending.items()):
+                if uid in self.Known_Uids:
+                    del self._pending[full_path]
+                    self.add_file(full_path, stat, uid)
+
+    def flush(self):
+        """
+        Write the recorded files into table FileIndex.
+        """
+        with self._lock:
+            if not self._ready:
+                return
+            con = sqlite3.connect(self.Database_Name)
+            try:
+                with con:
+                    con.executemany(r"insert or replace into FileIndex values (?,?,?,?);", self._ready)
+            except sqlite3.Error as e:
+                logging.error(str(e))
+            finally:
+                con.close()
+            self._ready = []
@@ -1,72 +1,463 @@
+import collections
+import collections.abc
+import io
+import logging
+import mmap
+import struct
+
 import dicom
 import numpy as np
-import logging
+
+from bat.StageTimer import StageTimer
+
+
+# The tags used by the evaluation, extracted once from the header into plain python values.
+# It is small and immutable, so it is what is sent to the worker processes and to the database layer
+# instead of the dicom header.
+DicomMetadata = collections.namedtuple("DicomMetadata", [
+    "FileName",
+    "Uid",
+    "SerialNumber",
+    "Modality",
+    "SoftwareVersion",
+    "PatientName",
+    "Slop",
+    "Intercept",
+    "Size",
+    "PixSpace",
+    "Instance",
+    "StudyDescription",
+    "Window",
+    "FOV",
+    "KVP",
+    "Current",
+    "Kernel",
+    "Series",
+    "TotalCollimation",
+    "OriginalCollimation",
+    "SliceThickness",
+    "TotalSlice",
+    "SliceMode",
+    "DateTime",
+    "ScanMode"])
+
+
+def plain_value(value):
+    """
+    Convert a dicom element value into a plain python value, e.g. DSfloat to float and MultiValue to tuple.
+    :param value: the value of a dicom element
+    :return: a float, int, str, bytes or a tuple of them
+    """
+    if isinstance(value, collections.abc.Sequence) and not isinstance(value, (str, bytes)):
+        return tuple(plain_value(v) for v in value)
+    if isinstance(value, (bytes, bool)):
+        return value
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, float):
+        return float(value)
+    return str(value)
 
 
 class DicomHandler:
-    def __init__(self, filename):
+    """
+    DicomHandler reads the header of a dicom file and parses the tags used by the evaluation into Metadata.
+    The header is not kept after parsing, every tag is an attribute of the same name read from Metadata.
+    The pixel data is only loaded when RawData is accessed.
+    With Memory_Map, the pixel data of an uncompressed file is memory mapped instead of decoded, see map_pixels.
+    """
+    Study_Description = r"Band Assessment"
+    # memory map the pixel data of the uncompressed little endian files, the others are still decoded
+    Memory_Map = False
+    Mappable_Transfer_Syntaxes = ("1.2.840.10008.1.2",     # implicit VR little endian
+                                  "1.2.840.10008.1.2.1")   # explicit VR little endian
+
+    def __init__(self, filename, header=None, content=None):
+        """
+        :param filename: input dicom file name including path
+        :param header: the already parsed header of the file or its DicomMetadata, e.g. from DirectoryHandler.
+        None to read the header from the file.
+        :param content: the bytes or a BytesIO of the whole file already read, e.g. by DirectoryHandler.iter_prefetch.
+        The header and the pixel data are parsed from it instead of the file. None to read the file.
+        """
         self.isComplete = False
         self.FileName = filename
+        self.Metadata = None
+        self._raw_data = None
+        self._content = content.getvalue() if isinstance(content, io.BytesIO) else content
 
         try:
-            self.Data = dicom.read_file(self.FileName)
-
-            # system related
-            self.SerialNumber = self.Data[0x0018, 0x1000].value
-            self.Modality = self.Data[0x0008, 0x1090].value
-            self.SoftwareVersion = self.Data[0x0018, 0x1020].value
-
-            # Image related
-            self.PatientName = self.Data[0x0010, 0x0010].value
-            self.Slop = self.Data[0x0028, 0x1053].value
-            self.Intercept = self.Data[0x0028, 0x1052].value
-            self.Size = (self.Data[0x0028, 0x0010].value,   # row
-                         self.Data[0x0028, 0x0011].value)   # col
-            self.PixSpace = self.Data[0x0028, 0x0030].value
-            self.Instance = self.Data[0x0020, 0x0013].value
-            self.PixSpace = self.Data[0x0028, 0x0030].value
-            self.StudyDescription = self.Data[0x0008, 0x1030].value
-            if self.StudyDescription != r"Band Assessment":
-                logging.warning(self.FileName + " is not Band Assessment. It is: " + self.FileName)
-                return
-
-            # Recon related
-            self.Window = (self.Data[0x0028, 0x1051].value,    # window width
-                           self.Data[0x0028, 0x1050].value)    # window center
-            self.FOV = self.Data[0x0018, 0x1100].value
-            self.RawData = np.array(self.Data.pixel_array)
-
-            # Scan related
-            self.KVP = self.Data[0x0018, 0x0060].value
-            self.Current = self.Data[0x0018, 0x1151].value
-            self.Kernel = self.Data[0x0018, 0x1210].value
-            self.Series = self.Data[0x0020, 0x0011].value
-            self.TotalCollimation = self.Data[0x0018, 0x9307].value
-            self.OriginalCollimation = self.Data[0x0029, 0x102c].value
-            self.SliceThickness = self.Data[0x0018, 0x0050].value
-            self.TotalSlice = int(self.TotalCollimation // self.SliceThickness)
-            self.DateTime = self.Data[0x0008, 0x002a].value
-            self.ScanMode = r"{0}kV_{1}mA_{2}_{3}({4})x{5}.{6}". \
-                format(str(self.KVP),
-                       str(self.Current),
-                       str(self.Kernel),
-                       str(self.TotalSlice),
-                       str(self.OriginalCollimation),
-                       str(self.SliceThickness),
-                       str(self.Instance))
-
-            # Extra
-            self.Uid = str(self.SerialNumber)+str(self.DateTime)+str(self.Instance)
+            if isinstance(header, DicomMetadata):
+                metadata = header
+            else:
+                metadata = self.read_metadata(filename, header, self._content)
         except Exception as e:
             logging.error("Dicom data parse error:" + str(e))
             return
+        if metadata is None:
+            return
 
+        self.Metadata = metadata
         self.isComplete = True
-        logging.info(r"Dicom " + str(self.FileName) + " initialed OK.")
+        logging.info(r"Dicom %s initialed OK.", self.FileName)
+
+    @classmethod
+    def read_metadata(cls, filename, header=None, content=None):
+        """
+        Parse the tags used by the evaluation.
+        :param filename: input dicom file name including path
+        :param header: the already parsed header of the file, None to read the header only from the file
+        :param content: the bytes of the whole file to parse the header from, None to read the file
+        :return: a DicomMetadata, None if the file is not Band Assessment.
+        An exception is raised if any tag is missing.
+        """
+        if header is None:
+            with StageTimer.measure("parse"):
+                header = dicom.read_file(filename if content is None else io.BytesIO(content),
+                                         stop_before_pixels=True)
+        study_description = header[0x0008, 0x1030].value
+        if study_description != cls.Study_Description:
+            logging.warning("%s is not Band Assessment. It is: %s", filename, study_description)
+            return None
+
+        # Scan related
+        kvp = header[0x0018, 0x0060].value
+        current = header[0x0018, 0x1151].value
+        kernel = header[0x0018, 0x1210].value
+        total_collimation = header[0x0018, 0x9307].value
+        original_collimation = header[0x0029, 0x102c].value
+        slice_thickness = header[0x0018, 0x0050].value
+        total_slice = int(total_collimation // slice_thickness)
+        instance = header[0x0020, 0x0013].value
+        # the strings are built from the dicom values, so they stay the same as the data already stored
+        scan_mode = r"{0}kV_{1}mA_{2}_{3}({4})x{5}.{6}". \
+            format(str(kvp),
+                   str(current),
+                   str(kernel),
+                   str(total_slice),
+                   str(original_collimation),
+                   str(slice_thickness),
+                   str(instance))
+
+        return DicomMetadata(FileName=filename,
+                             Uid=cls.header_uid(header),
+                             # system related
+                             SerialNumber=plain_value(header[0x0018, 0x1000].value),
+                             Modality=plain_value(header[0x0008, 0x1090].value),
+                             SoftwareVersion=plain_value(header[0x0018, 0x1020].value),
+                             # Image related
+                             PatientName=plain_value(header[0x0010, 0x0010].value),
+                             Slop=plain_value(header[0x0028, 0x1053].value),
+                             Intercept=plain_value(header[0x0028, 0x1052].value),
+                             Size=(plain_value(header[0x0028, 0x0010].value),   # row
+                                   plain_value(header[0x0028, 0x0011].value)),  # col
+                             PixSpace=plain_value(header[0x0028, 0x0030].value),
+                             Instance=plain_value(instance),
+                             StudyDescription=plain_value(study_description),
+                             # Recon related
+                             Window=(plain_value(header[0x0028, 0x1051].value),   # window width
+                                     plain_value(header[0x0028, 0x1050].value)),  # window center
+                             FOV=plain_value(header[0x0018, 0x1100].value),
+                             # Scan related
+                             KVP=plain_value(kvp),
+                             Current=plain_value(current),
+                             Kernel=plain_value(kernel),
+                             Series=plain_value(header[0x0020, 0x0011].value),
+                             TotalCollimation=plain_value(total_collimation),
+                             OriginalCollimation=plain_value(original_collimation),
+                             SliceThickness=plain_value(slice_thickness),
+                             TotalSlice=total_slice,
+                             SliceMode=str(total_slice) + "x" + str(slice_thickness),
+                             DateTime=str(header[0x0008, 0x002a].value),
+                             ScanMode=scan_mode)
+
+    @staticmethod
+    def header_uid(header):
+        """
+        Build the Uid (SerialNumber + DateTime + Instance) from a header, same as the Uid attribute.
+        :param header: a dicom header, the pixel data is not needed
+        :return: the Uid string
+        """
+        return str(header[0x0018, 0x1000].value) + \
+            str(header[0x0008, 0x002a].value) + \
+            str(header[0x0020, 0x0013].value)
+
+    def _metadata(self):
+        """
+        :return: Metadata, an AttributeError is raised if the header is not parsed
+        """
+        if self.Metadata is None:
+            raise AttributeError(str(self.FileName) + " has no metadata, it is not a complete Band Assessment file")
+        return self.Metadata
+
+    @property
+    def Uid(self):
+        """
+        Metadata.Uid: SerialNumber + DateTime + Instance, the key of the record in database
+        """
+        return self._metadata().Uid
+
+    @property
+    def SerialNumber(self):
+        """
+        Metadata.SerialNumber: the serial number of the scanner
+        """
+        return self._metadata().SerialNumber
+
+    @property
+    def Modality(self):
+        """
+        Metadata.Modality: the scanner model
+        """
+        return self._metadata().Modality
+
+    @property
+    def SoftwareVersion(self):
+        """
+        Metadata.SoftwareVersion: the software version of the scanner
+        """
+        return self._metadata().SoftwareVersion
+
+    @property
+    def PatientName(self):
+        """
+        Metadata.PatientName: the patient name
+        """
+        return self._metadata().PatientName
+
+    @property
+    def Slop(self):
+        """
+        Metadata.Slop: the rescale slope of the pixel data
+        """
+        return self._metadata().Slop
+
+    @property
+    def Intercept(self):
+        """
+        Metadata.Intercept: the rescale intercept of the pixel data
+        """
+        return self._metadata().Intercept
+
+    @property
+    def Size(self):
+        """
+        Metadata.Size: the image size as (row, col)
+        """
+        return self._metadata().Size
+
+    @property
+    def PixSpace(self):
+        """
+        Metadata.PixSpace: the pixel spacing as (row, col) in mm
+        """
+        return self._metadata().PixSpace
+
+    @property
+    def Instance(self):
+        """
+        Metadata.Instance: the instance number
+        """
+        return self._metadata().Instance
+
+    @property
+    def StudyDescription(self):
+        """
+        Metadata.StudyDescription: the study description
+        """
+        return self._metadata().StudyDescription
+
+    @property
+    def Window(self):
+        """
+        Metadata.Window: the window as (window width, window center)
+        """
+        return self._metadata().Window
+
+    @property
+    def FOV(self):
+        """
+        Metadata.FOV: the reconstruction field of view in mm
+        """
+        return self._metadata().FOV
+
+    @property
+    def KVP(self):
+        """
+        Metadata.KVP: the tube voltage in kV
+        """
+        return self._metadata().KVP
+
+    @property
+    def Current(self):
+        """
+        Metadata.Current: the tube current in mA
+        """
+        return self._metadata().Current
+
+    @property
+    def Kernel(self):
+        """
+        Metadata.Kernel: the reconstruction kernel
+        """
+        return self._metadata().Kernel
+
+    @property
+    def Series(self):
+        """
+        Metadata.Series: the series number
+        """
+        return self._metadata().Series
+
+    @property
+    def TotalCollimation(self):
+        """
+        Metadata.TotalCollimation: the total collimation width in mm
+        """
+        return self._metadata().TotalCollimation
+
+    @property
+    def OriginalCollimation(self):
+        """
+        Metadata.OriginalCollimation: the original collimation, the number of acquired slices
+        """
+        return self._metadata().OriginalCollimation
+
+    @property
+    def SliceThickness(self):
+        """
+        Metadata.SliceThickness: the slice thickness in mm
+        """
+        return self._metadata().SliceThickness
+
+    @property
+    def TotalSlice(self):
+        """
+        Metadata.TotalSlice: TotalCollimation // SliceThickness
+        """
+        return self._metadata().TotalSlice
+
+    @property
+    def SliceMode(self):
+        """
+        Metadata.SliceMode: TotalSlice x SliceThickness, e.g. "32x0.6"
+        """
+        return self._metadata().SliceMode
+
+    @property
+    def DateTime(self):
+        """
+        Metadata.DateTime: the acquisition date time
+        """
+        return self._metadata().DateTime
+
+    @property
+    def ScanMode(self):
+        """
+        Metadata.ScanMode: the scan parameters as one string, used in the saved file names
+        """
+        return self._metadata().ScanMode
+
+    @property
+    def RawData(self):
+        """
+        The pixel data of the image, it is decoded from the file or the content at the first access.
+        The content is released after the decode.
+        :return: a np array of the stored pixel value
+        """
+        if self._raw_data is None:
+            with StageTimer.measure("decode"):
+                raw_data = None
+                if self._content is not None:
+                    raw_data = np.array(dicom.read_file(io.BytesIO(self._content)).pixel_array)
+                    self._content = None
+                elif self.Memory_Map:
+                    try:
+                        raw_data = self.map_pixels(self.FileName)
+                    except Exception as e:
+                        logging.warning(r"%s can not be memory mapped: %s", self.FileName, e)
+                if raw_data is None:
+                    raw_data = np.array(dicom.read_file(self.FileName).pixel_array)
+                self._raw_data = raw_data
+            logging.debug(r"Pixel data loaded: %s", self.FileName)
+        return self._raw_data
+
+    @classmethod
+    def map_pixels(cls, filename):
+        """
+        Memory map the pixel data of an uncompressed file as a read only np array, no pixel is copied.
+        The pages are read from disk when they are touched and stay in the page cache of the system,
+        so a file read again, e.g. by another worker, is not read from the disk or network twice.
+        :param filename: input dicom file name including path
+        :return: a np array in the shape of (row, col), None if the file is not mappable and must be decoded
+        """
+        with open(filename, "rb") as f:
+            # the parse stops at the start of the pixel data element, so its header is read from there
+            dataset = dicom.read_file(f, stop_before_pixels=True)
+            file_meta = getattr(dataset, "file_meta", None)
+            # str of a dicom UID is its name, the UID itself compares equal to the plain string
+            if file_meta is None or file_meta.TransferSyntaxUID not in cls.Mappable_Transfer_Syntaxes:
+                return None
+            if int(dataset.get("SamplesPerPixel", 1)) != 1 or int(dataset.get("NumberOfFrames", 1)) != 1:
+                return None
+            bits = int(dataset.BitsAllocated)
+            if bits not in (8, 16, 32):
+                return None
+            dtype = np.dtype(("<i" if int(dataset.PixelRepresentation) == 1 else "<u") + str(bits // 8))
+            shape = (int(dataset.Rows), int(dataset.Columns))
+            is_implicit_vr = file_meta.TransferSyntaxUID == cls.Mappable_Transfer_Syntaxes[0]
+            offset, length = cls._pixel_element(f, is_implicit_vr)
+            if offset is None or length != shape[0] * shape[1] * dtype.itemsize:
+                # an undefined length is the encapsulated pixel data of a compressed file
+                return None
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, "madvise"):
+            # the whole slice is read once in order by the HU conversion
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        # the array keeps the mapping open until it is released
+        return np.frombuffer(mapped, dtype=dtype, count=shape[0] * shape[1], offset=offset).reshape(shape)
+
+    @staticmethod
+    def _pixel_element(f, is_implicit_vr):
+        """
+        Read the header of the pixel data element at the current position of the file.
+        :param f: the file positioned at the start of the element, e.g. after a parse with stop_before_pixels
+        :param is_implicit_vr: True for the implicit VR little endian transfer syntax
+        :return: a tuple as (file offset of the value, length of the value), (None, None) if it is not
+        the pixel data element
+        """
+        element = f.read(8)
+        if len(element) < 8:
+            return None, None
+        group, number = struct.unpack("<HH", element[:4])
+        if (group, number) != (0x7fe0, 0x0010):
+            return None, None
+        if is_implicit_vr:
+            length = struct.unpack("<I", element[4:])[0]
+        elif element[4:6] in (b"OB", b"OW", b"OF", b"UN"):
+            # these VRs have 2 reserved bytes and a 4 bytes length
+            extra = f.read(4)
+            if len(extra) < 4:
+                return None, None
+            length = struct.unpack("<I", extra)[0]
+        else:
+            length = struct.unpack("<H", element[6:])[0]
+        return f.tell(), length
 
 
 if __name__ == '__main__':
     print("please do not use it individually unless of debugging.")
 
-    a = DicomHandler(r"../../../tests/a.dcm")
+    import os
+    import sys
+    import tempfile
+    from bat.PhantomGenerator import phantom_hu
+    from bat.PhantomGenerator import write_phantom
+
+    # read the file given in command line, or a generated phantom
+    if len(sys.argv) > 1:
+        dicom_file = sys.argv[1]
+    else:
+        dicom_file = write_phantom(os.path.join(tempfile.mkdtemp(), r"phantom.dcm"), phantom_hu())
+    a = DicomHandler(dicom_file)
     print(a.isComplete)
@@ -1,51 +1,256 @@
 #!coding=utf8
+import collections
+import concurrent.futures
+import itertools
 import logging
 import os
 
 import dicom
 
+from bat.DicomHandler import DicomHandler
+from bat.StageTimer import StageTimer
+
 
 class DirectoryHandler:
     """
-    The class will iterate the input directory to find target database file.
-    And store each found file full path in a list of string "Database_File_Path"
+    The class will iterate the input directory to find target dicom file.
+    The files are yielded one by one while the directory tree is walked, so the processing can start at once.
+    Only the header of each file is read, the pixel data is skipped.
+    The DicomMetadata of each Band Assessment file is yielded with its path so DicomHandler does not parse it again,
+    the dicom header itself is dropped at once.
+    With a DatabaseHandler.FileIndex, the unchanged files and the already stored uids are skipped.
     """
-    Dicom_File_Path = []
-    Total_Dicom_Quantity = 0
+    Study_Description = r"Band Assessment"
+    # returned instead of a header if the file could not be read, e.g. a network error.
+    # Such a file is not recorded in the FileIndex, so it is tried again next time.
+    Read_Failed = object()
 
-    def __init__(self, input_directory):
+    def __init__(self, input_directory, index=None):
         """
         :param input_directory:
+        :param index: a DatabaseHandler.FileIndex for incremental processing, None to yield all files
         """
+        self.Index = index
+        self.Skipped_Quantity = 0
+        self.Dicom_File_Path = []
+        self.Dicom_Headers = {}
+        self.Total_Dicom_Quantity = 0
+        self.Root = None
         if input_directory is not None:
             if os.path.isdir(input_directory):
                 logging.info(r"Input is a folder.")
             else:
                 logging.error(r"input is not a folder. Procedure quited.")
                 return
-        absolute_path = os.path.abspath(input_directory)
-        self.list_files(absolute_path)
+            self.Root = os.path.abspath(input_directory)
 
-    def list_files(self, input_directory):
+    def iter_paths(self):
         """
-        :param input_directory:
-        :return: no return. Directly write all target files found in Database_File_Path
-        """
-        dir_list = os.listdir(input_directory)
-        for dl in dir_list:
-            full_dl = os.path.join(input_directory, dl)
-            if os.path.isfile(full_dl):
-                try:
-                    # try to open the dicom file.
-                    _ = dicom.read_file(full_dl)[0x0018, 0x1000].value
-                    self.Dicom_File_Path.append(full_dl)
-                    self.Total_Dicom_Quantity += 1
-                    logging.info(str(full_dl))
-                except Exception as e:
-                    logging.info(str(full_dl))
-                    logging.error(str(e))
-            else:
-                self.list_files(full_dl)
+        Walk the directory tree by os.scandir without recursion.
+        :return: a generator of the full path of every file
+        """
+        for entry in self._iter_entries():
+            yield entry.path
+
+    def _iter_entries(self):
+        if self.Root is None:
+            return
+        folders = [self.Root]
+        while folders:
+            folder = folders.pop()
+            # list one folder at a time, so the time of the walk is measured without the consumer
+            files = []
+            try:
+                with StageTimer.measure("discover"):
+                    with os.scandir(folder) as entries:
+                        for entry in entries:
+                            if entry.is_dir(follow_symlinks=False):
+                                folders.append(entry.path)
+                            elif entry.is_file():
+                                files.append(entry)
+            except OSError as e:
+                logging.error(r"%s: %s", folder, e)
+            yield from files
+
+    def read_header(self, full_path):
+        """
+        Read the header of a file and check if it is a Band Assessment dicom file.
+        :param full_path: the full path of the file
+        :return: the dicom header, None if the file is not a Band Assessment dicom file,
+        Read_Failed if the file could not be read
+        """
+        try:
+            # try to open the dicom file header only.
+            with StageTimer.measure("parse"):
+                header = dicom.read_file(full_path, stop_before_pixels=True)
+            _ = header[0x0018, 0x1000].value
+            study_description = header[0x0008, 0x1030].value
+        except OSError as e:
+            logging.error(r"%s can not be read: %s", full_path, e)
+            return self.Read_Failed
+        except Exception as e:
+            logging.info(r"%s", full_path)
+            logging.error(r"%s", e)
+            return None
+        if study_description != self.Study_Description:
+            logging.info(r"%s is not Band Assessment. It is: %s", full_path, study_description)
+            return None
+        logging.info(r"%s", full_path)
+        return header
+
+    def read_metadata(self, full_path):
+        """
+        Read the header of a file and parse it into a DicomMetadata.
+        :param full_path: the full path of the file
+        :return: the DicomMetadata, None if the file is not a complete Band Assessment dicom file,
+        Read_Failed if the file could not be read
+        """
+        header = self.read_header(full_path)
+        if header is None or header is self.Read_Failed:
+            return header
+        try:
+            return DicomHandler.read_metadata(full_path, header)
+        except Exception as e:
+            logging.error(r"%s: %s", full_path, e)
+            return None
+
+    def read_file(self, full_path, read_content=False, rules=None):
+        """
+        Read one file for iter_prefetch, it runs on a reader thread.
+        Only the header is read first, the whole file is only read if it is going to be decoded:
+        a Band Assessment file not stored yet and with any analysis of the rules.
+        :param full_path: the full path of the file
+        :param read_content: read the whole file of a processed slice, so its pixel data is decoded from memory
+        :param rules: the SliceRules to select the processed slices, None to read every Band Assessment file
+        :return: a tuple as (DicomMetadata, None or Read_Failed, the bytes of the file or None)
+        """
+        metadata = self.read_metadata(full_path)
+        if metadata is None or metadata is self.Read_Failed or not read_content:
+            return metadata, None
+        # Known_Uids is only read here, it is safe without the lock of FileIndex
+        if self.Index is not None and self.Index.is_known_uid(metadata.Uid):
+            return metadata, None
+        if rules is not None and not rules.analyses(metadata):
+            return metadata, None
+        try:
+            with StageTimer.measure("read"):
+                with open(full_path, "rb") as f:
+                    return metadata, f.read()
+        except OSError as e:
+            # the file is read again by the decode
+            logging.error(r"%s: %s", full_path, e)
+            return metadata, None
+
+    def _candidates(self):
+        """
+        :return: a generator of (full path, stat) of each file to read, the stat is None if not incremental
+        """
+        for entry in self._iter_entries():
+            if self.Index is None:
+                yield entry.path, None
+                continue
+            # incremental: skip the unchanged file without opening it
+            stat = self.Index.file_stat(entry.path, entry.stat())
+            if self.Index.is_known_file(entry.path, stat):
+                self.Skipped_Quantity += 1
+                continue
+            yield entry.path, stat
+
+    def _accept(self, full_path, stat, metadata):
+        """
+        Record a read file in the FileIndex. A file which could not be read is not recorded.
+        :return: True if the file should be processed
+        """
+        if metadata is self.Read_Failed:
+            return False
+        if self.Index is None:
+            return metadata is not None
+        uid = metadata.Uid if metadata is not None else None
+        self.Index.add_file(full_path, stat, uid)
+        if uid is not None and self.Index.is_known_uid(uid):
+            logging.info(r"%s is already stored as: %s", full_path, uid)
+            self.Skipped_Quantity += 1
+            return False
+        return metadata is not None
+
+    def iter_files(self):
+        """
+        :return: a generator of (full path, DicomMetadata) of each Band Assessment file
+        """
+        for full_path, stat in self._candidates():
+            metadata = self.read_metadata(full_path)
+            if self._accept(full_path, stat, metadata):
+                yield full_path, metadata
+
+    def iter_prefetch(self, depth=16, readers=4, read_content=False, rules=None):
+        """
+        Same as iter_files, but the files are read by a pool of reader threads while the consumer is processing,
+        so the disk or network and the CPU are busy at the same time.
+        At most depth files are read ahead of the consumer, the walk waits until the consumer takes one,
+        so the memory is bounded. The files are yielded in the same order as iter_files.
+        The directory walk and the FileIndex stay in the consumer thread.
+        :param depth: the number of files read ahead, 0 or less to read in the current thread
+        :param readers: the number of reader threads
+        :param read_content: also read the whole file into memory, then (full path, DicomMetadata, bytes or None)
+        is yielded and the pixel data is decoded from the bytes without reading the file again
+        :param rules: the SliceRules, only the slices with any analysis are read into memory
+        :return: a generator of (full path, DicomMetadata) of each Band Assessment file
+        """
+        if depth <= 0:
+            if not read_content:
+                yield from self.iter_files()
+                return
+            for full_path, stat in self._candidates():
+                metadata, content = self.read_file(full_path, True, rules)
+                if self._accept(full_path, stat, metadata):
+                    yield full_path, metadata, content
+            return
+        pending = collections.deque()
+        candidates = self._candidates()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(readers, depth)),
+                                                   thread_name_prefix="DirectoryPrefetch") as executor:
+            try:
+                while True:
+                    for full_path, stat in itertools.islice(candidates, depth - len(pending)):
+                        future = executor.submit(self.read_file, full_path, read_content, rules)
+                        pending.append((full_path, stat, future))
+                    if not pending:
+                        break
+                    full_path, stat, future = pending.popleft()
+                    try:
+                        metadata, content = future.result()
+                    except Exception as e:
+                        logging.error(r"%s: %s", full_path, e)
+                        metadata, content = self.Read_Failed, None
+                    if not self._accept(full_path, stat, metadata):
+                        continue
+                    if read_content:
+                        yield full_path, metadata, content
+                    else:
+                        yield full_path, metadata
+            finally:
+                # the consumer stopped early, the files not started yet are not read
+                for _, _, future in pending:
+                    future.cancel()
+
+    def estimate_total(self):
+        """
+        Count the files under the directory without opening them.
+        It is an upper bound of the Band Assessment file quantity.
+        :return: the number of files
+        """
+        return sum(1 for _ in self.iter_paths())
+
+    def list_files(self):
+        """
+        Walk the whole directory and keep the result in memory.
+        :return: the list of the full path of each Band Assessment file, also stored in Dicom_File_Path
+        """
+        for full_path, metadata in self.iter_files():
+            self.Dicom_File_Path.append(full_path)
+            self.Dicom_Headers[full_path] = metadata
+            self.Total_Dicom_Quantity += 1
+        return self.Dicom_File_Path
 
 
 if __name__ == '__main__':
@@ -1,13 +1,17 @@
+import collections
 import logging
-import math
 
-import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFilter
 
 from bat.DicomHandler import DicomHandler
+from bat.IqResult import IqResult
+from bat.ProfileFilter import median_filter
+from bat.RenderHandler import Renderer
+from bat.StageTimer import StageTimer
+from bat.Stencil import RadialProfile
+from bat.Stencil import RoiStencil
+from bat.Stencil import bresenham_ring
+from bat.Stencil import bresenham_theta
 
 
 class ImageHandler(DicomHandler):
@@ -16,16 +20,46 @@ class ImageHandler(DicomHandler):
     The ImageHandler class can provide more functions based on the DicomHandler class
     to deal with image related calculation.
     """
-
-    def __init__(self, filename, window=(50, 0)):
+    # "bresenham" keeps the result identical to the data already stored in database.
+    # "radius" uses every pixel of the ring, see RadialProfile.
+    Integration_Mode = "bresenham"
+    # the median filter applied on the integration result, see ProfileFilter.median_filter
+    Median_Width = 8
+    Median_Edge = "truncate"
+    # the number of rescaled images kept for different windows
+    Display_Cache_Size = 2
+    # the calculated center is only used if its confidence is high enough, otherwise the image center is used
+    Center_Confidence_Min = 0.9
+    # calc_circle result per acquisition (SerialNumber, DateTime, Series, FOV, Size), the oldest is dropped
+    # when Circle_Cache_Size acquisitions are kept
+    Circle_Cache = {}
+    Circle_Cache_Size = 64
+    # the deviation to the min HU counted as warning / error by evaluate_iq
+    Warning_Threshold = 2.5
+    Error_Threshold = 3.5
+    # the images and plots are saved by the Renderer, which can be switched off or run on a background thread
+    Render = Renderer("sync")
+    # a ResultCache to reuse the integration and the ROI ring of evaluate_iq, None to always calculate
+    Result_Cache = None
+
+    def __init__(self, filename, window=(50, 0), integration_mode=None, header=None, content=None):
         """
         Initialization function
         :param filename: input dicom file name including path
+        :param window: the window to rescale the image as (window width, window center)
+        :param integration_mode: the RadialProfile mode, None to use the class default
+        :param header: the already parsed dicom header or DicomMetadata, None to read it from the file
+        :param content: the bytes of the whole file already read, None to read the file
         """
         self.isImageComplete = False
+        self._pixel_hash = None
+        self.Window_Setting = tuple(window)
+        self._display_cache = collections.OrderedDict()
+        if integration_mode is not None:
+            self.Integration_Mode = integration_mode
         try:
             # call super to init DicomHandler class first
-            super(self.__class__, self).__init__(filename)
+            super(self.__class__, self).__init__(filename, header, content)
         except Exception as e:
             logging.error(str(e))
         if not self.isComplete:
@@ -33,20 +67,25 @@ class ImageHandler(DicomHandler):
             return
 
         try:
-            # Convert to HU unit
-            self.ImageHU = self.RawData * self.Slop + self.Intercept
-            self.ImageRaw = self.ImageHU.copy()
-            # calculate first time that can show image according pre-set windowing
-            self.rescale_image(window)
+            # Convert to HU unit in float32, the rescaled image is only calculated when ImageRaw is used
+            raw_data = self.RawData
+            with StageTimer.measure("hu"):
+                self.ImageHU = np.multiply(raw_data, float(self.Slop), dtype=np.float32)
+                self.ImageHU += np.float32(self.Intercept)
             # center is always in format (row, col)
             # Radius is always in format (radius in pixel, radius in cm)
-            self.Center, self.Radius = self.calc_circle
-            self.Center = (256, 256)
+            with StageTimer.measure("calc_circle"):
+                self.Center, self.Radius = self.calc_circle
+            if self.Circle_Confidence < self.Center_Confidence_Min:
+                logging.warning(r"Low confidence of the calculated center, use image center now!")
+                self.Center = (self.Size[0] // 2, self.Size[1] // 2)
             # define circular integration result
             self.Image_Integration_Result = np.zeros(self.Radius[0])
             self.Image_Median_Filter_Result = np.zeros(self.Radius[0])
             # main calculation
             self.integration()
+            # the HU image is kept, the stored pixel values are not needed any more
+            self._raw_data = None
         except Exception as e:
             logging.error(str(e))
             return
@@ -57,103 +96,174 @@ class ImageHandler(DicomHandler):
     def rescale_image(self, window: tuple):
         """
         rescale the image to set the data in range (0~255)
+        The window is also kept as Window_Setting, which is used by ImageRaw.
+        The last Display_Cache_Size windows are cached, a returned array is never changed afterwards.
         :param window: a tuple pass in as (window width, window center)
         :return: return a np array as rescaled image
         """
-        raw_data = self.ImageHU.copy()
+        window = (float(window[0]), float(window[1]))
+        self.Window_Setting = window
+        display = self._display_cache.get(window)
+        if display is not None:
+            self._display_cache.move_to_end(window)
+            return display
+        # drop the oldest window if the cache is full. Its array may still be used by a caller,
+        # so it is never reused as the buffer of the new window.
+        if len(self._display_cache) >= self.Display_Cache_Size:
+            self._display_cache.popitem(last=False)
         window_upper = window[1] + window[0] / 2
         window_lower = window[1] - window[0] / 2
-        # make filter according to center and width
-        upper_filter = raw_data > window_upper
-        raw_data[upper_filter] = window_upper  # set upper value
-        lower_filter = raw_data < window_lower
-        raw_data[lower_filter] = window_lower  # set lower value
-        # rescale the data to 0~255
-        min_hu_image = raw_data.min()
-        max_hu_image = raw_data.max()
+        # set the value out of window to the window limit
+        display = np.clip(self.ImageHU, window_lower, window_upper)
+        # rescale the data to 0~255, the min/max after clip come from the min/max of the HU image
+        min_hu_image = min(max(self.ImageHU_Range[0], window_lower), window_upper)
+        max_hu_image = min(max(self.ImageHU_Range[1], window_lower), window_upper)
+        display -= min_hu_image
         if min_hu_image == max_hu_image:
-            self.ImageRaw = (raw_data - min_hu_image) * 255
+            display *= 255
         else:
             # rescale the image to fit 0~255
-            self.ImageRaw = (raw_data - min_hu_image) * 255 / (max_hu_image - min_hu_image)
+            display *= 255 / (max_hu_image - min_hu_image)
+        self._display_cache[window] = display
+        return display
+
+    @property
+    def Pixel_Hash(self):
+        """
+        The hash of the pixel data and the HU conversion, the base of every ResultCache key of the image.
+        """
+        if self._pixel_hash is None:
+            self._pixel_hash = self.Result_Cache.pixel_hash(self.RawData, self.Slop, self.Intercept)
+        return self._pixel_hash
+
+    @property
+    def ImageHU_Range(self):
+        """
+        :return: a tuple as (min HU, max HU) of the image, calculated once
+        """
+        if getattr(self, "_hu_range", None) is None:
+            self._hu_range = (float(self.ImageHU.min()), float(self.ImageHU.max()))
+        return self._hu_range
+
+    @property
+    def ImageRaw(self):
+        """
+        The image rescaled to 0~255 by Window_Setting, calculated at the first use and cached.
+        :return: a float32 np array
+        """
+        return self.rescale_image(self.Window_Setting)
 
     @property
     def calc_circle(self):
+        """
+        Calculate the image center and radius, see find_circle.
+        The result is cached per acquisition (SerialNumber, DateTime, Series, FOV, Size), because the phantom
+        is not moved between the slices of one acquisition, but it can be placed elsewhere in the next session.
+        Only a result with confidence >= Center_Confidence_Min is cached.
+        The confidence is kept as Circle_Confidence.
+        :return: return 2 tuples which are image center and radius
+        (center row, center col),(radius in pixel, radius in cm)
+        """
+        key = (str(self.SerialNumber), str(self.DateTime), str(self.Series), str(self.FOV), tuple(self.Size))
+        cached = self.Circle_Cache.get(key)
+        if cached is None:
+            cached = self.find_circle(self.ImageRaw, self.Size, self.PixSpace)
+            if cached[2] >= self.Center_Confidence_Min:
+                if len(self.Circle_Cache) >= self.Circle_Cache_Size:
+                    # dict keeps the insertion order, the 1st key is the oldest acquisition
+                    del self.Circle_Cache[next(iter(self.Circle_Cache))]
+                self.Circle_Cache[key] = cached
+        else:
+            logging.debug(r"Circle found in cache for: %s", key)
+        center, radius, self.Circle_Confidence = cached
+        return center, radius
+
+    @staticmethod
+    def _edge_distance(image, line):
+        """
+        Find the 1st edge pixel from both ends of one line of the image.
+        The edge is the same as PIL FIND_EDGES (8 at center, -1 around, clipped to 0~255, border pixels kept),
+        but only calculated on the needed line.
+        :param image: the 8-bit image as a np array of int
+        :param line: the index of the row
+        :return: a tuple as (distance from start, distance from end, True if any edge is found),
+        the distance is counted from index 1 as the PIL based loop did
+        """
+        band = image[line - 1:line + 2]
+        edge = band[1].copy()
+        edge[1:-1] = 9 * band[1, 1:-1] - band[:, :-2].sum(axis=0) - band[:, 1:-1].sum(axis=0) - \
+            band[:, 2:].sum(axis=0)
+        edge = edge > 0
+        forward = edge[1:]
+        backward = edge[:0:-1]
+        if not forward.any():
+            return len(edge) - 1, len(edge) - 1, False
+        return int(np.argmax(forward)) + 1, int(np.argmax(backward)) + 1, True
+
+    @classmethod
+    def find_circle(cls, display, size, pix_space):
         """
         Calculate the image center and radius
         the method is simple
-        from up/down/left/right side to go into center
-        the 1st number is > mean value, it's the edge
+        from left/right side of the center row to go into center, the 1st edge pixel is the phantom edge.
+        Then do the same from up/down side on the calculated center col.
         calculate the distance from th edge to center
-        :return: return 2 tuples which are image center and radius 
-        (center row, center col),(radius in pixel, radius in cm)
+        The confidence compares the horizontal and vertical diameter, 0 if the center is abnormal.
+        :param display: the image rescaled to 0~255, see rescale_image
+        :param size: the image size as (row, col)
+        :param pix_space: the pixel spacing of the image
+        :return: return 3 values which are image center, radius and confidence
+        (center row, center col),(radius in pixel, radius in cm), confidence in 0~1
         """
         # set up some local variables
         is_abnormal = False
-        center_col = self.Size[1] // 2
-        center_row = self.Size[0] // 2
-        left_distance = 0
-        right_distance = 0
-        up_distance = 0
-        low_distance = 0
+        center_col = size[1] // 2
+        center_row = size[0] // 2
         max_allowed_deviation = 20
-        # Using PIL to find edge and convert back to np array
-        # This will make calculation more accuracy
-        filtered_image = np.array(
-            Image.fromarray(self.ImageRaw).convert("L").filter(ImageFilter.FIND_EDGES)
-        )
+        # same as PIL convert("L"): clip and truncate
+        image = np.clip(display, 0, 255).astype(np.int16)
 
         # start to calculate center col
-        for left_distance in range(1, self.Size[1]):
-            if filtered_image[center_row, left_distance] != 0:
-                break
-        for right_distance in range(1, self.Size[1]):
-            if filtered_image[center_row, self.Size[1] - right_distance] != 0:
-                break
+        left_distance, right_distance, found = cls._edge_distance(image, center_row)
         center_col += (left_distance - right_distance) // 2
-        logging.debug(r"Center Col calculated as: " + str(center_col))
+        logging.debug(r"Center Col calculated as: %s", center_col)
         # if the calculated center col deviated too much
-        if (self.Size[0] // 2 + max_allowed_deviation) < center_col < (self.Size[0] // 2 - max_allowed_deviation):
+        if not found or abs(center_col - size[1] // 2) > max_allowed_deviation:
             logging.warning(r"It seems abnormal when calculate Center Col, use image center now!")
-            center_col = self.Size[1] // 2
+            center_col = size[1] // 2
             is_abnormal = True
 
         # start to calculate center row
-        for up_distance in range(1, self.Size[0]):
-            if filtered_image[up_distance, center_col] != 0:
-                break
-        for low_distance in range(1, self.Size[0]):
-            if filtered_image[self.Size[0] - low_distance, center_col] != 0:
-                break
+        up_distance, low_distance, found = cls._edge_distance(image.T, center_col)
         center_row += (up_distance - low_distance) // 2
-        logging.debug(r"Center Row calculated as: " + str(center_row))
+        logging.debug(r"Center Row calculated as: %s", center_row)
         # if the calculated center row deviated too much
-        if (self.Size[1] // 2 + max_allowed_deviation) < center_row < (self.Size[1] // 2 - max_allowed_deviation):
+        if not found or abs(center_row - size[0] // 2) > max_allowed_deviation:
             logging.warning(r"It seems abnormal when calculate Center row, use image center now!")
-            center_row = self.Size[0] // 2
+            center_row = size[0] // 2
             is_abnormal = True
 
         # set different radius according to normal/abnormal situation
         if is_abnormal is False:
-            radius = (self.Size[0] - left_distance - right_distance) // 2
-            diameter_in_cm = radius * self.PixSpace[0] * 2
-            logging.debug(str(radius) + r"pix (radius), " + str(diameter_in_cm) +
-                          r"cm(diameter)<==Calculated phantom diameter")
+            radius = (size[0] - left_distance - right_distance) // 2
+            diameter_in_cm = radius * pix_space[0] * 2
+            vertical_radius = (size[0] - up_distance - low_distance) // 2
+            confidence = 1 - abs(radius - vertical_radius) / max(radius, vertical_radius, 1)
+            logging.debug(r"%spix (radius), %scm(diameter)<==Calculated phantom diameter", radius, diameter_in_cm)
             # standardize the radius
             if diameter_in_cm < 250:
                 radius = 233
-                logging.debug(str(radius) + r"pix" + r", which is: " +
-                              str(radius * self.PixSpace[0] * 2) + r"cm <==Radius Readjusted")
+                logging.debug(r"%spix, which is: %scm <==Radius Readjusted", radius, radius * pix_space[0] * 2)
             else:
                 radius = 220
-                logging.debug(str(radius) + r"pix" + r", which is: " +
-                              str(radius * self.PixSpace[0] * 2) + r"cm <==Radius Readjusted")
+                logging.debug(r"%spix, which is: %scm <==Radius Readjusted", radius, radius * pix_space[0] * 2)
         else:
             logging.warning(r"Calculated center is abnormal, use 50 as radius!")
             radius = 50
-            diameter_in_cm = radius * self.PixSpace[0]
+            diameter_in_cm = radius * pix_space[0]
+            confidence = 0.0
 
-        return (center_row, center_col), (radius, diameter_in_cm)
+        return (center_row, center_col), (radius, diameter_in_cm), max(0.0, float(confidence))
 
     def bresenham(self, center: tuple, radius: int):
         """
@@ -187,24 +297,19 @@ class ImageHandler(DicomHandler):
 
     def roi_measure(self, center: tuple, radius):
         """
-        Use self.bresenham multiple times to get sum of all pixel value and the total count.
-        Then sum of pixcel value / total counts = mean hu value that is the mean HU in the circular ROI
+        Measure the mean HU value in the circular ROI which is made up of the bresenham circles 1 ~ radius-1.
+        The pixels are gathered at once by the cached RoiStencil of the radius.
         :param center: a tuple indicates where the circle center is as (row, col)
         :param radius: the radius in PIXEL
         :return: The mean HU value of the ROI
         """
-        result_hu = 0
-        result_count = 0
-        for index in range(1, radius):
-            _result = self.bresenham(center, index)
-            result_hu += _result[0]
-            result_count += _result[1]
-        return result_hu / result_count
+        return float(RoiStencil.get(radius).measure(self.ImageHU, [center])[0])
 
     def find_center_roi_min(self, radius, deviation):
         """
         Use a defined circle with radius to measure the HU value. And moving around the circle
         position in deviation range to find where the minum HU value is.
+        The ROI mean of the whole search window is calculated at once as a surface, then the min is found by argmin.
         :param radius: The radius of circular ROI in PIXEL
         :param deviation: The Square range to let the circle moving around.
         :return: return a tuple as (min result, min position) where a min position is a tuple as (row, col)
@@ -213,18 +318,35 @@ class ImageHandler(DicomHandler):
         result_min = self.roi_measure(self.Center, 10)
         min_row = self.Center[0]
         min_col = self.Center[1]
-        # start to find the min HU value
-        for index_row in range(self.Center[0] - deviation, self.Center[0] + deviation):
-            for index_col in range(self.Center[1] - deviation, self.Center[1] + deviation):
-                result = self.roi_measure((index_row, index_col), radius)
-                if result < result_min:
-                    result_min = result
-                    min_row = index_row
-                    min_col = index_col
+        # calculate the ROI mean of each position in search window
+        surface = RoiStencil.get(radius).surface(self.ImageHU, self.Center, deviation)
+        if surface.size > 0:
+            # argmin returns the 1st min in row major order, same as the scanning order
+            index_row, index_col = np.unravel_index(np.argmin(surface), surface.shape)
+            if surface[index_row, index_col] < result_min:
+                result_min = float(surface[index_row, index_col])
+                min_row = self.Center[0] - deviation + int(index_row)
+                min_col = self.Center[1] - deviation + int(index_col)
         # pack the min value position in image
         min_position = (min_row, min_col)
         return result_min, min_position
 
+    def circular_roi(self, center: tuple, radius: int, radius_inner: int):
+        """
+        1st define a bresenham circle with center (row, col) and a radius in PIXEL. Then on each point on the edge
+        of the defined circle, a ROI with radius_inner in PIXEL will be measured.
+        All ROIs are measured at once by the RoiStencil of radius_inner.
+        :param center: The defined circle center as a tuple (row, col)
+        :param radius: The radius of the defined circle
+        :param radius_inner: the radius of the ROI measurement on each point of the defined circle's edge.
+        :return: return 3 np arrays. 1) the HU value of each ROI.
+        2) the position as (row, col) of each point in shape (count, 2).
+        3) the angle in degree of each point around the center.
+        """
+        circular_pos = bresenham_ring(radius) + np.asarray(center, dtype=np.intp)
+        circular_result = RoiStencil.get(radius_inner).measure(self.ImageHU, circular_pos)
+        return circular_result, circular_pos, bresenham_theta(radius)
+
     def circular_bresenham(self, center: tuple, radius: int, radius_inner: int):
         """
         1st define a circle with center (row, col) and a radius in PIXEL. Then on each point on the edge of the
@@ -237,202 +359,112 @@ class ImageHandler(DicomHandler):
         :return: return 2 values. 1) circular_result as a
         list of the HU value. 2) a list contains position as (row, col) of each point
         """
-        x = 0
-        y = radius
-        d = 3 - 2 * radius
-        circular_result = []
-        circular_pos = []
-        while x < y:
-            circular_result.append(self.roi_measure((center[0] - y, center[1] + x), radius_inner))
-            circular_result.append(self.roi_measure((center[0] + y, center[1] + x), radius_inner))
-            circular_result.append(self.roi_measure((center[0] - y, center[1] - x), radius_inner))
-            circular_result.append(self.roi_measure((center[0] + y, center[1] - x), radius_inner))
-            circular_result.append(self.roi_measure((center[0] - x, center[1] + y), radius_inner))
-            circular_result.append(self.roi_measure((center[0] - x, center[1] - y), radius_inner))
-            circular_result.append(self.roi_measure((center[0] + x, center[1] + y), radius_inner))
-            circular_result.append(self.roi_measure((center[0] + x, center[1] - y), radius_inner))
-            # record the position to draw afterward
-            circular_pos.append(([center[0] - y, center[1] + x]))
-            circular_pos.append(([center[0] + y, center[1] + x]))
-            circular_pos.append(([center[0] - y, center[1] - x]))
-            circular_pos.append(([center[0] + y, center[1] - x]))
-            circular_pos.append(([center[0] - x, center[1] + y]))
-            circular_pos.append(([center[0] - x, center[1] - y]))
-            circular_pos.append(([center[0] + x, center[1] + y]))
-            circular_pos.append(([center[0] + x, center[1] - y]))
-            if d < 0:
-                d = d + 4 * x + 6
-            else:
-                d = d + 4 * (x - y) + 10
-                y -= 1
-            x += 1
-        return circular_result, circular_pos
+        circular_result, circular_pos, _ = self.circular_roi(center, radius, radius_inner)
+        return circular_result.tolist(), circular_pos.tolist()
 
-    def evaluate_iq(self, diameter_in_mm, deviation_in_mm):
+    @staticmethod
+    def iq_geometry(diameter_in_mm, deviation_in_mm, pix_space):
+        """
+        Convert the evaluate_iq parameters into PIXEL.
+        :param diameter_in_mm: the size of the ROI
+        :param deviation_in_mm: the half size of the square search range
+        :param pix_space: the pixel spacing of the image
+        :return: a tuple as (ROI radius in pixel, deviation in pixel)
         """
+        # convert diamter_in_mm into radius in pixel
+        # radius = int((diameter_in_mm / self.PixSpace[0]) / 2)
+        radius = int((diameter_in_mm / 3.14159265) ** 0.5 / pix_space[0])
+        # convert deviation in mm into deviation in pixel
+        deviation = int(deviation_in_mm / pix_space[0])
+        return radius, deviation
 
-        :param diameter_in_mm:
-        :param deviation_in_mm:
-        :return:
+    def evaluate_iq(self, diameter_in_mm, deviation_in_mm):
+        """
+        Find the min HU ROI around the center, then measure the ROIs on a circle around it.
+        The deviation of each ROI to the min HU is plotted and drawn on the image.
+        :param diameter_in_mm: the size of the ROI
+        :param deviation_in_mm: the half size of the square range to search the min HU ROI
+        :return: an IqResult, None if the image is incomplete
         """
         if not self.isImageComplete:
             logging.warning(r"Image initialed incomplete. Procedure quited.")
             return
 
-        # convert diamter_in_mm into radius in pixel
-        # radius = int((diameter_in_mm / self.PixSpace[0]) / 2)
-        radius = int((diameter_in_mm / 3.14159265) ** 0.5 / self.PixSpace[0])
-        # convert deviation in mm into deviation in pixel
-        deviation = int(deviation_in_mm / self.PixSpace[0])
-
-        min_hu, min_pos = self.find_center_roi_min(radius, deviation)
-        result, pos = self.circular_bresenham(min_pos, radius * 2 + 2, radius)
-        max_hu = max(result)
-        for i in range(0, len(result)):
-            result[i] = result[i] - min_hu
-
-        max_deviation = max(result)
-        max_dev_position = pos[result.index(max_deviation)]
-
-        # experiment of find theta
-        theta = []
-        for p in pos:
-            y = min_pos[0] - p[0]
-            x = p[1] - min_pos[1]
-            if x == 0:
-                if y > 0:
-                    theta.append(90)
-                else:
-                    theta.append(270)
-            elif y == 0:
-                if x > 0:
-                    theta.append(0)
-                if x < 0:
-                    theta.append(180)
+        with StageTimer.measure("evaluate_iq"):
+            radius, deviation = self.iq_geometry(diameter_in_mm, deviation_in_mm, self.PixSpace)
+            # the thresholds are not part of the key, the cached ring is classified again
+            cache = self.Result_Cache
+            entry = None
+            if cache is not None:
+                key = cache.key("iq", self.Pixel_Hash, tuple(int(c) for c in self.Center), radius, deviation)
+                entry = cache.get(key)
+            if entry is not None:
+                min_hu = float(entry["min_hu"])
+                min_pos = tuple(int(p) for p in entry["min_pos"])
+                ring, pos, theta = entry["ring"], entry["pos"], entry["theta"]
             else:
-                if not (not (x > 0) or not (y > 0)):
-                    theta.append(int(math.degrees(math.atan(y / x))))
-                elif x < 0 < y:
-                    theta.append(int((math.degrees(math.atan(y / x)) * -1) + 90))
-                elif x < 0 and y < 0:
-                    theta.append(int(math.degrees(math.atan(y / x)) + 180))
-                else:
-                    theta.append(int((math.degrees(math.atan(y / x)) * -1) + 270))
-        union_result = []
-        for i in range(0, len(result)):
-            union_result.append((theta[i], result[i]))
-        sorted_result_tuple = sorted(union_result, key=lambda t: t[0])
-        sorted_result = []
-        for r in sorted_result_tuple:
-            sorted_result.append(r[1])
-
-        # Prepare to draw the image evaluation fig plot
-        image__filename__fig = "_IqEval_fig.jpeg"
-        limit_h = []
-        limit_l = []
-        limit_h1 = []
-        limit_l1 = []
-        result_count = len(result)
-        warning_thresh_hold = 2.5
-        warning_count = 0
-        error_thresh_hold = 3.5
-        error_count = 0
-        for r in result:
-            if r >= warning_thresh_hold:
-                warning_count += 1
-            if r >= error_thresh_hold:
-                error_count += 1
-            limit_h.append(warning_thresh_hold)
-            limit_h1.append(error_thresh_hold)
-            limit_l.append(warning_thresh_hold * -1)
-            limit_l1.append(error_thresh_hold * -1)
-        plt.plot(limit_h)
-        plt.plot(limit_l)
-        plt.plot(limit_h1)
-        plt.plot(limit_l1)
-        plt.plot(sorted_result)
-        plt.savefig(self.FileName + "_" + self.ScanMode + image__filename__fig)
-        plt.close()
-
-        # prepare to save the evaluation result
-        image__filename = "_IqEval.jpeg"
-        im = Image.fromarray(self.ImageRaw).convert("L")
-        pixel_map = im.load()
-        draw = ImageDraw.Draw(im)
-        # draw the min center positoin
-        pixel_map[min_pos[1], min_pos[0]] = 0
-        pixel_map[min_pos[1] + 1, min_pos[0]] = 0
-        pixel_map[min_pos[1] - 1, min_pos[0]] = 0
-        pixel_map[min_pos[1], min_pos[0] + 1] = 0
-        pixel_map[min_pos[1], min_pos[0] - 1] = 0
-        # draw the max deviation center position
-        pixel_map[max_dev_position[1], max_dev_position[0]] = 0
-        pixel_map[max_dev_position[1] + 1, max_dev_position[0]] = 0
-        pixel_map[max_dev_position[1] - 1, max_dev_position[0]] = 0
-        pixel_map[max_dev_position[1], max_dev_position[0] + 1] = 0
-        pixel_map[max_dev_position[1], max_dev_position[0] - 1] = 0
-        # draw the Image Center Position
-        pixel_map[self.Center[1], self.Center[0]] = 0
-        pixel_map[self.Center[1] + 1, self.Center[0]] = 0
-        pixel_map[self.Center[1] - 1, self.Center[0]] = 0
-        pixel_map[self.Center[1], self.Center[0] + 1] = 0
-        pixel_map[self.Center[1], self.Center[0] - 1] = 0
-        # Draw circle
-        text_pos = deviation
-        draw.ellipse((min_pos[1] - radius, min_pos[0] - radius, min_pos[1] + radius, min_pos[0] + radius))
-        draw.text((min_pos[1], min_pos[0] + text_pos), str("Middle Min HU:" + str(min_hu)))
-        draw.ellipse((max_dev_position[1] - radius, max_dev_position[0] - radius, max_dev_position[1] + radius,
-                      max_dev_position[0] + radius))
-        draw.text((max_dev_position[1], max_dev_position[0] + text_pos), str("Around Max HU:" + str(max_hu)))
-        draw.text((200, 100), str("Max HU Deviation:" + str(max_deviation)))
-        draw.text((200, 110), str("error rate:" + str(error_count / result_count * 100) + "%"))
-        draw.text((200, 120), str("warning rate:" + str(warning_count / result_count * 100) + "%"))
-        im.save(self.FileName + "_" + self.ScanMode + image__filename, "png")
+                min_hu, min_pos = self.find_center_roi_min(radius, deviation)
+                ring, pos, theta = self.circular_roi(min_pos, radius * 2 + 2, radius)
+                if cache is not None:
+                    cache.put(key, min_hu=min_hu, min_pos=min_pos, ring=ring, pos=pos, theta=theta)
+            result = ring - min_hu
+            max_dev_position = pos[np.argmax(result)]
+            # sort the result by the angle around the min position
+            evaluation = IqResult(min_hu, min_pos, ring.max(), max_dev_position,
+                                  result[np.argsort(theta, kind="stable")],
+                                  self.Warning_Threshold, self.Error_Threshold)
+
+        # plot the sorted deviation and draw the evaluation on the image
+        if self.Render.Enabled:
+            self.Render.save_iq(self.FileName + "_" + self.ScanMode,
+                                Renderer.to_8bit(self.ImageRaw),
+                                dict(evaluation.as_dict(),
+                                     sorted_result=evaluation.Ring,
+                                     center=tuple(int(c) for c in self.Center),
+                                     radius=radius,
+                                     deviation=deviation))
+        return evaluation
 
     def integration(self):
         """
-
-        :return:
+        Calculate the circular integration for each radius in one pass by RadialProfile, or reuse it from
+        Result_Cache. Then apply the median filter on the integration result, which is cheap and not cached.
+        :return: no return. Directly write Image_Integration_Result and Image_Median_Filter_Result
         """
         # calculate circular integration for each radius
-        for index in range(1, len(self.Image_Integration_Result)):
-            result = self.bresenham(self.Center, index)
-            self.Image_Integration_Result[index] = result[0] / result[1]
+        with StageTimer.measure("integration"):
+            cache = self.Result_Cache
+            entry = None
+            if cache is not None:
+                key = cache.key("integration", self.Pixel_Hash, tuple(int(c) for c in self.Center),
+                                len(self.Image_Integration_Result), self.Integration_Mode)
+                entry = cache.get(key)
+            if entry is not None:
+                self.Image_Integration_Result = entry["profile"]
+            else:
+                profile = RadialProfile.get(len(self.Image_Integration_Result), self.Integration_Mode)
+                self.Image_Integration_Result = profile.integrate(self.ImageHU, self.Center)
+                if cache is not None:
+                    cache.put(key, profile=self.Image_Integration_Result)
         # calculate data by using Median
         # for the rest of the data, do the median filter with width
-        _width = 8
-        for index in range(len(self.Image_Integration_Result) - _width):
-            self.Image_Median_Filter_Result[index] = np.median(
-                self.Image_Integration_Result[index:index + _width])
+        with StageTimer.measure("median"):
+            self.Image_Median_Filter_Result = median_filter(
+                self.Image_Integration_Result, self.Median_Width, self.Median_Edge)
 
     def save_image(self):
         """
-
+        Save the image and the plot of the median filter result by Renderer.
         :return:
         """
         if not self.isImageComplete:
             logging.warning(r"Image initialed incomplete. Procedure quited.")
             return
-        # set up the output file name
-        image__filename = ".jpeg"
-        image__filename__fig = "_fig.jpeg"
-        im = Image.fromarray(self.ImageRaw).convert("L")
-        # save image
-        try:
-            # save image
-            im.save(self.FileName + "_" + self.ScanMode + image__filename, "png")
-            # draw fig
-            plt.plot(self.Image_Median_Filter_Result)
-            plt.ylim((-5, 20))
-            plt.xlim((0, 250))
-            # draw fig image
-            plt.savefig(self.FileName + "_" + self.ScanMode + image__filename__fig)
-            plt.close()
-        except Exception as e:
-            logging.error(str(e))
+        if not self.Render.Enabled:
             return
-        finally:
-            plt.close()
+        self.Render.save_image(self.FileName + "_" + self.ScanMode,
+                               Renderer.to_8bit(self.ImageRaw),
+                               self.Image_Median_Filter_Result)
 
     def show_image(self):
         """
@@ -442,6 +474,7 @@ class ImageHandler(DicomHandler):
         if not self.isImageComplete:
             logging.warning(r"Image initialed incomplete. Procedure quited.")
             return
+        from PIL import Image
         return Image.fromarray(self.ImageRaw).convert("L")
 
     def show_integration_result(self):
@@ -462,6 +495,18 @@ if __name__ == '__main__':
                         format='%(asctime)s %(filename)s[line:%(lineno)d] %(levelname)s %(message)s',
                         datefmt='%a, %d %b %Y %H:%M:%S')
 
-    img = ImageHandler('a.dcm')
+    import os
+    import sys
+    import tempfile
+    from bat.PhantomGenerator import phantom_hu
+    from bat.PhantomGenerator import write_phantom
+
+    # read the file given in command line, or a generated phantom
+    if len(sys.argv) > 1:
+        dicom_file = sys.argv[1]
+    else:
+        dicom_file = write_phantom(os.path.join(tempfile.mkdtemp(), r"phantom.dcm"),
+                                   phantom_hu(rings=((100, 5.0, 1.0),), noise=3.0))
+    img = ImageHandler(dicom_file)
     img.rescale_image((2, 100))
     img.save_image()
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class IqResult:
+    """
+    IqResult is the result of the image quality evaluation of one image, see ImageHandler.evaluate_iq.
+    Record is a compact np record in Dtype with the metrics and the classification.
+    Ring is the deviation of each ROI on the ring to the min HU, sorted by the angle around the min position.
+    The classification only depends on Ring and the thresholds, so it can be done again by classify
+    for many stored rings at once without processing any image.
+    """
+    __slots__ = ("Record", "Ring")
+    Dtype = np.dtype([("min_hu", "f8"),
+                      ("min_pos", "i4", (2,)),
+                      ("max_hu", "f8"),
+                      ("max_deviation", "f8"),
+                      ("max_dev_position", "i4", (2,)),
+                      ("warning_threshold", "f8"),
+                      ("error_threshold", "f8"),
+                      ("ring_count", "i4"),
+                      ("warning_count", "i4"),
+                      ("error_count", "i4"),
+                      ("warning_rate", "f8"),
+                      ("error_rate", "f8")])
+
+    def __init__(self, min_hu, min_pos, max_hu, max_dev_position, ring, warning_threshold, error_threshold):
+        """
+        :param min_hu: the min ROI mean found around the center
+        :param min_pos: the position of the min ROI as (row, col)
+        :param max_hu: the max ROI mean on the ring
+        :param max_dev_position: the position of the max deviation ROI as (row, col)
+        :param ring: the deviation of each ROI to min_hu, sorted by angle
+        :param warning_threshold: the deviation counted as warning
+        :param error_threshold: the deviation counted as error
+        """
+        self.Ring = np.asarray(ring, dtype=np.float64)
+        counts = self.classify(self.Ring, warning_threshold, error_threshold)
+        self.Record = np.array((min_hu, min_pos, max_hu, np.max(self.Ring), max_dev_position,
+                                warning_threshold, error_threshold) + tuple(counts), dtype=self.Dtype)[()]
+
+    @staticmethod
+    def classify(rings, warning_threshold, error_threshold):
+        """
+        Count the ROIs over the thresholds, vectorized over all rings.
+        :param rings: a 1-D ring or a 2-D np array with one ring per row, the shorter rings padded by nan
+        :param warning_threshold: a threshold or a np array of one threshold per ring
+        :param error_threshold: a threshold or a np array of one threshold per ring
+        :return: a tuple of (ring_count, warning_count, error_count, warning_rate, error_rate),
+        each is a scalar for a 1-D ring or a np array of one value per ring
+        """
+        rings = np.asarray(rings, dtype=np.float64)
+        warning_threshold = np.asarray(warning_threshold, dtype=np.float64)
+        error_threshold = np.asarray(error_threshold, dtype=np.float64)
+        if rings.ndim > 1:
+            warning_threshold = warning_threshold[..., None]
+            error_threshold = error_threshold[..., None]
+        # nan is never over a threshold, so the padding is not counted
+        ring_count = np.count_nonzero(~np.isnan(rings), axis=-1)
+        warning_count = np.count_nonzero(rings >= warning_threshold, axis=-1)
+        error_count = np.count_nonzero(rings >= error_threshold, axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (ring_count, warning_count, error_count,
+                    warning_count / ring_count, error_count / ring_count)
+
+    def reclassify(self, warning_threshold, error_threshold):
+        """
+        :return: a new IqResult with the same measurement classified by other thresholds
+        """
+        record = self.Record
+        return IqResult(record["min_hu"], record["min_pos"], record["max_hu"], record["max_dev_position"],
+                        self.Ring, warning_threshold, error_threshold)
+
+    def as_dict(self):
+        """
+        :return: a dict of the metrics in python types, the positions as (row, col) tuples
+        """
+        result = {}
+        for name in self.Dtype.names:
+            value = self.Record[name]
+            if value.shape:
+                result[name] = tuple(int(v) for v in value)
+            elif np.issubdtype(value.dtype, np.integer):
+                result[name] = int(value)
+            else:
+                result[name] = float(value)
+        return result
+
+    def __repr__(self):
+        return "IqResult(" + ", ".join(k + "=" + str(v) for k, v in self.as_dict().items()) + ")"
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
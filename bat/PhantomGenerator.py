@@ -0,0 +1,122 @@
+import datetime
+import uuid
+
+import numpy as np
+
+# The SOP class of a CT image and the uncompressed explicit VR little endian transfer syntax
+CT_Image_Storage = r"1.2.840.10008.5.1.4.1.1.2"
+Explicit_VR_Little_Endian = r"1.2.840.10008.1.2.1"
+
+
+def phantom_uid(name):
+    """
+    :param name: any string which identifies the object, the same name always gives the same uid
+    :return: a dicom uid in the 2.25 (uuid derived) root
+    """
+    return r"2.25." + str(uuid.uuid5(uuid.NAMESPACE_URL, name).int)
+
+
+def phantom_hu(size=512, pix_space=0.48828125, diameter_in_mm=240.0, center_offset=(0, 0),
+               water_hu=0.0, air_hu=-1000.0, rings=(), noise=0.0, seed=0):
+    """
+    Create the HU image of a water cylinder phantom with ring / band artifacts.
+    :param size: the rows and cols of the image
+    :param pix_space: the pixel spacing in mm
+    :param diameter_in_mm: the diameter of the water cylinder
+    :param center_offset: the offset of the cylinder center to the image center as (row, col) in pixel
+    :param water_hu: the HU value inside the cylinder
+    :param air_hu: the HU value outside the cylinder
+    :param rings: a list of (radius in pixel, amplitude in HU, width in pixel) around the cylinder center.
+    A width of about 1 is a ring artifact, a wider one is a band artifact.
+    :param noise: the standard deviation of the gaussian noise in HU
+    :param seed: the seed of the noise, the same seed always gives the same image
+    :return: a np array of float64 in shape (size, size)
+    """
+    center = (size / 2 + center_offset[0], size / 2 + center_offset[1])
+    row, col = np.ogrid[:size, :size]
+    distance = np.hypot(row - center[0], col - center[1])
+    inside = distance <= diameter_in_mm / pix_space / 2
+    image = np.where(inside, water_hu, air_hu).astype(np.float64)
+    for radius, amplitude, width in rings:
+        image[inside] += amplitude * np.exp(-0.5 * ((distance[inside] - radius) / max(width, 1e-3)) ** 2)
+    if noise > 0:
+        image += np.random.default_rng(seed).normal(0.0, noise, image.shape)
+    return image
+
+
+def write_phantom(filename, image_hu, instance=1, series=1, serial_number=r"99999",
+                  date_time=datetime.datetime(2017, 1, 1, 12, 0, 0), kernel=r"Hr40f", kvp=120, current=100,
+                  total_collimation=19.2, original_collimation=32, slice_thickness=0.6, pix_space=0.48828125,
+                  study_description=r"Band Assessment"):
+    """
+    Write the HU image as an uncompressed CT dicom file with all the tags DicomHandler reads,
+    including the private original collimation (0029,102c).
+    :param filename: the output dicom file name
+    :param image_hu: the HU image, e.g. from phantom_hu
+    :param instance: the instance number, it is part of DicomHandler.Uid
+    :param series: the series number
+    :param serial_number: the scanner serial number, it is part of DicomHandler.Uid
+    :param date_time: the acquisition date time, it is part of DicomHandler.Uid
+    :return: the file name
+    """
+    from dicom.dataset import Dataset
+    from dicom.dataset import FileDataset
+
+    size = image_hu.shape
+    date_time_string = date_time.strftime(r"%Y%m%d%H%M%S") + r".000000"
+    name = serial_number + date_time_string + str(series) + "." + str(instance)
+    sop_instance_uid = phantom_uid(r"image:" + name)
+
+    file_meta = Dataset()
+    file_meta.MediaStorageSOPClassUID = CT_Image_Storage
+    file_meta.MediaStorageSOPInstanceUID = sop_instance_uid
+    file_meta.ImplementationClassUID = phantom_uid(r"BandAssessmentPlus")
+    file_meta.TransferSyntaxUID = Explicit_VR_Little_Endian
+    ds = FileDataset(filename, {}, file_meta=file_meta, preamble=b"\0" * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.add_new(0x00080016, "UI", CT_Image_Storage)
+    ds.add_new(0x00080018, "UI", sop_instance_uid)
+    ds.add_new(0x0008002a, "DT", date_time_string)
+    ds.add_new(0x00080060, "CS", r"CT")
+    ds.add_new(0x00081030, "LO", study_description)
+    ds.add_new(0x00081090, "LO", r"Phantom")
+    ds.add_new(0x00100010, "PN", r"Band^Assessment")
+    ds.add_new(0x00180050, "DS", str(slice_thickness))
+    ds.add_new(0x00180060, "DS", str(kvp))
+    ds.add_new(0x00181000, "LO", serial_number)
+    ds.add_new(0x00181020, "LO", r"Phantom")
+    ds.add_new(0x00181100, "DS", str(pix_space * size[1]))
+    ds.add_new(0x00181151, "IS", str(current))
+    ds.add_new(0x00181210, "SH", kernel)
+    ds.add_new(0x00189307, "FD", float(total_collimation))
+    ds.add_new(0x0020000d, "UI", phantom_uid(r"study:" + serial_number + date_time_string))
+    ds.add_new(0x0020000e, "UI", phantom_uid(r"series:" + serial_number + date_time_string + str(series)))
+    ds.add_new(0x00200011, "IS", str(series))
+    ds.add_new(0x00200013, "IS", str(instance))
+    ds.add_new(0x00280002, "US", 1)
+    ds.add_new(0x00280004, "CS", r"MONOCHROME2")
+    ds.add_new(0x00280010, "US", size[0])
+    ds.add_new(0x00280011, "US", size[1])
+    ds.add_new(0x00280030, "DS", [str(pix_space), str(pix_space)])
+    ds.add_new(0x00280100, "US", 16)
+    ds.add_new(0x00280101, "US", 12)
+    ds.add_new(0x00280102, "US", 11)
+    ds.add_new(0x00280103, "US", 0)
+    ds.add_new(0x00281050, "DS", r"40")
+    ds.add_new(0x00281051, "DS", r"400")
+    ds.add_new(0x00281052, "DS", r"-1024")
+    ds.add_new(0x00281053, "DS", r"1")
+    # the private block of the original collimation
+    ds.add_new(0x00290010, "LO", r"SIEMENS CT VA0  COAD")
+    ds.add_new(0x0029102c, "US", original_collimation)
+
+    stored = np.clip(np.round(np.asarray(image_hu) + 1024), 0, 4095).astype("<u2")
+    ds.add_new(0x7fe00010, "OW", stored.tobytes())
+    ds.save_as(filename)
+    return filename
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
@@ -0,0 +1,249 @@
+import collections
+import concurrent.futures
+import logging
+import logging.handlers
+import multiprocessing
+import sys
+
+from bat.DatabaseHandler import SQL3Writer
+from bat.DicomHandler import DicomHandler
+from bat.ImageHandler import ImageHandler
+from bat.RenderHandler import Renderer
+from bat.ResultCache import ResultCache
+from bat.SliceRules import SliceRules
+from bat.StageTimer import StageTimer
+
+# The small result of one processed file, which is sent back from the worker process.
+# The attribute names are the same as ImageHandler, so SQL3Handler can store it directly.
+ImageResult = collections.namedtuple("ImageResult", [
+    "Metadata",
+    "Image_Integration_Result",
+    "Image_Median_Filter_Result",
+    "IqResult"])
+
+
+def settings():
+    """
+    :return: the class settings of ImageHandler which the worker processes need to apply, see configure
+    """
+    return {"Integration_Mode": ImageHandler.Integration_Mode,
+            "Median_Width": ImageHandler.Median_Width,
+            "Median_Edge": ImageHandler.Median_Edge,
+            "Warning_Threshold": ImageHandler.Warning_Threshold,
+            "Error_Threshold": ImageHandler.Error_Threshold,
+            "Render_Mode": ImageHandler.Render.Mode,
+            "Memory_Map": DicomHandler.Memory_Map,
+            "Timing": StageTimer.Enabled,
+            "Log_Level": logging.getLogger().level,
+            "Result_Cache": None if ImageHandler.Result_Cache is None else
+            (ImageHandler.Result_Cache.Cache_Directory, ImageHandler.Result_Cache.Max_Size)}
+
+
+def configure(image_settings, log_queue=None):
+    """
+    The initializer of the worker processes. A spawned worker imports ImageHandler again with the default settings,
+    so the settings of the main process are applied here.
+    The worker renders in its own thread, it is already parallel and must not exit with renders pending.
+    :param image_settings: the dict from settings
+    :param log_queue: the queue of the QueueListener in the main process, the log records of the worker are sent
+    to it, so they are written to the log file by the main process. None to keep the logging of the worker.
+    """
+    if log_queue is not None:
+        # a forked worker inherits the handlers of the main process, they must not write the log file twice
+        root = logging.getLogger()
+        for handler in root.handlers[:]:
+            root.removeHandler(handler)
+        root.addHandler(logging.handlers.QueueHandler(log_queue))
+        root.setLevel(image_settings["Log_Level"])
+    ImageHandler.Integration_Mode = image_settings["Integration_Mode"]
+    ImageHandler.Median_Width = image_settings["Median_Width"]
+    ImageHandler.Median_Edge = image_settings["Median_Edge"]
+    ImageHandler.Warning_Threshold = image_settings["Warning_Threshold"]
+    ImageHandler.Error_Threshold = image_settings["Error_Threshold"]
+    render_mode = image_settings["Render_Mode"]
+    ImageHandler.Render = Renderer("off" if render_mode == "off" else "sync")
+    DicomHandler.Memory_Map = image_settings["Memory_Map"]
+    StageTimer.Enabled = image_settings["Timing"]
+    if image_settings["Result_Cache"] is not None:
+        ImageHandler.Result_Cache = ResultCache(*image_settings["Result_Cache"])
+
+
+def process_file(filename, header=None, window=(70, -5), analyses=None, content=None):
+    """
+    Process one dicom file: parse, integrate, save image and evaluate the image quality.
+    It runs in the worker process, so only the small ImageResult is returned.
+    :param filename: input dicom file name including path
+    :param header: the already parsed dicom header or DicomMetadata, None to read it from the file
+    :param window: the window to rescale the image as (window width, window center)
+    :param analyses: the analyses from SliceRules.analyses, None to check the default SliceRules here
+    :param content: the bytes of the whole file already read, e.g. by DirectoryHandler.iter_prefetch
+    :return: an ImageResult, or None if the file is not a complete Band Assessment image or has no analysis
+    """
+    if analyses is None:
+        dicom_image = DicomHandler(filename, header, content)
+        if not dicom_image.isComplete:
+            return None
+        analyses = SliceRules().analyses(dicom_image)
+        header = dicom_image.Metadata
+    if not analyses:
+        return None
+    _image = ImageHandler(filename, window=window, header=header, content=content)
+    if not _image.isImageComplete:
+        return None
+    _image.save_image()
+    iq_result = None
+    if "iq" in analyses:
+        iq_result = _image.evaluate_iq(100, 2)
+    return ImageResult(Metadata=_image.Metadata,
+                       Image_Integration_Result=_image.Image_Integration_Result,
+                       Image_Median_Filter_Result=_image.Image_Median_Filter_Result,
+                       IqResult=iq_result)
+
+
+def process_file_timed(filename, header=None, analyses=None, content=None):
+    """
+    process_file in the worker process, the stage timings of the worker are sent back with the result.
+    :return: a tuple as (ImageResult or None, the samples of StageTimer.drain)
+    """
+    return process_file(filename, header, analyses=analyses, content=content), StageTimer.drain()
+
+
+class Pipeline:
+    """
+    Pipeline runs process_file for every input file, in the current process or in a process pool,
+    and stores the results into database by the main process as the single SQL3Writer.
+    The SliceRules are checked by the main process on the header, a file without analysis is never decoded.
+    """
+    Batch_Size = 256
+
+    def __init__(self, workers=1, batch_size=None, index=None, rules=None):
+        """
+        :param workers: the number of worker processes. 1 or less runs everything in the current process.
+        :param batch_size: the number of results inserted into database at once
+        :param index: a DatabaseHandler.FileIndex which is told the stored uids, None if not incremental
+        :param rules: the SliceRules, None to use the default rules
+        """
+        self.Workers = max(1, int(workers))
+        self.Index = index
+        self.Rules = rules if rules is not None else SliceRules()
+        self.Rule_Skipped_Quantity = 0
+        if batch_size is not None:
+            self.Batch_Size = batch_size
+        self.Processed_Quantity = 0
+        self.Inserted_Quantity = 0
+
+    def _select(self, files):
+        """
+        Check the SliceRules on the header of each file.
+        :return: a generator of (filename, header, analyses, content) of the files with any analysis
+        """
+        # the content is only there if the prefetch read the whole file
+        for _file, header, *content in files:
+            dicom_image = DicomHandler(_file, header)
+            if not dicom_image.isComplete:
+                continue
+            analyses = self.Rules.analyses(dicom_image)
+            if not analyses:
+                self.Rule_Skipped_Quantity += 1
+                if self.Index is not None:
+                    self.Index.mark_checked(_file)
+                continue
+            yield _file, dicom_image.Metadata, analyses, content[0] if content else None
+
+    def _results(self, files):
+        """
+        Generate (filename, result) of each file. The number of files in flight is bounded,
+        so the files can be a generator and the results never pile up in memory.
+        """
+        if self.Workers == 1:
+            for _file, header, analyses, content in self._select(files):
+                try:
+                    yield _file, process_file(_file, header, analyses=analyses, content=content)
+                except Exception as e:
+                    logging.error(str(_file) + ": " + str(e))
+                    yield _file, None
+            return
+        # the log records of the workers are written by the handlers of the main process
+        log_queue = multiprocessing.Queue()
+        listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers,
+                                                  respect_handler_level=True)
+        listener.start()
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.Workers, initializer=configure,
+                                                        initargs=(settings(), log_queue)) as executor:
+                pending = {}
+                for _file, header, analyses, content in self._select(files):
+                    pending[executor.submit(process_file_timed, _file, header, analyses, content)] = _file
+                    if len(pending) >= self.Workers * 2:
+                        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            yield self._collect(future, pending.pop(future))
+                for future in concurrent.futures.as_completed(pending):
+                    yield self._collect(future, pending[future])
+        finally:
+            # the workers have exited, every record they sent is in the queue
+            listener.stop()
+            log_queue.close()
+
+    @staticmethod
+    def _collect(future, filename):
+        try:
+            result, samples = future.result()
+            StageTimer.merge(samples)
+            return filename, result
+        except Exception as e:
+            logging.error(str(filename) + ": " + str(e))
+            return filename, None
+
+    def run(self, files, total=None):
+        """
+        Process all the files and store the results.
+        :param files: an iterable of (dicom file name, DicomMetadata or None), or with the bytes of the file as
+        the 3rd item, e.g. DirectoryHandler.iter_prefetch()
+        :param total: the total quantity of the files to show the progress, None if unknown
+        :return: the number of inserted records
+        """
+        on_commit = self.Index.add_uids if self.Index is not None else None
+        with SQL3Writer(batch_size=self.Batch_Size, on_commit=on_commit) as writer:
+            for _file, result in self._results(files):
+                self.Processed_Quantity += 1
+                if total is None:
+                    sys.stdout.write(f"\r{self.Processed_Quantity:d}: ")
+                else:
+                    sys.stdout.write(f"\r{self.Processed_Quantity:d}/{total:d}: ")
+                if result is None:
+                    logging.warning(r"%s is not stored: it has no result", _file)
+                    continue
+                writer.write(result)
+        # wait for the renders still queued on the background thread
+        ImageHandler.Render.close()
+        self.Inserted_Quantity += writer.Inserted_Quantity
+        if self.Index is not None:
+            self.Index.flush()
+        return self.Inserted_Quantity
+
+    def run_series(self, series_list):
+        """
+        Process whole series by SeriesHandler in the current process and store the results.
+        :param series_list: a list of SeriesHandler, e.g. from SeriesHandler.group_files
+        :return: the number of inserted records
+        """
+        on_commit = self.Index.add_uids if self.Index is not None else None
+        with SQL3Writer(batch_size=self.Batch_Size, on_commit=on_commit) as writer:
+            for count, series in enumerate(series_list, start=1):
+                sys.stdout.write(f"\rseries {count:d}/{len(series_list):d}: ")
+                try:
+                    results = series.results()
+                except Exception as e:
+                    logging.error(str(series.Key) + ": " + str(e))
+                    continue
+                self.Processed_Quantity += len(results)
+                writer.write_many(results)
+        self.Inserted_Quantity += writer.Inserted_Quantity
+        if self.Index is not None:
+            self.Index.flush()
+        return self.Inserted_Quantity
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
@@ -0,0 +1,51 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# How to filter the last (width - 1) positions, whose window runs over the end of the profile:
+# "zero": leave them at 0, same as the old per window loop (which also left position n - width at 0).
+# "truncate": the median of the remaining values only.
+# "reflect": the profile is mirrored at the end, e.g. (... c d | c b ...).
+# "nearest": the last value is repeated.
+Edge_Modes = ("zero", "truncate", "reflect", "nearest")
+
+
+def median_filter(profiles, width=8, edge="truncate"):
+    """
+    Filter the profiles by the median of the forward window [index, index + width) in one vectorized call.
+    :param profiles: a 1-D profile or a stack of profiles in shape (..., length)
+    :param width: the width of the median window
+    :param edge: one of Edge_Modes
+    :return: a np array in the same shape as profiles
+    """
+    if edge not in Edge_Modes:
+        raise ValueError("Unknown median filter edge mode: " + str(edge))
+    profiles = np.asarray(profiles, dtype=np.float64)
+    length = profiles.shape[-1]
+    if width <= 1:
+        return profiles.copy()
+
+    if edge == "zero":
+        result = np.zeros_like(profiles)
+        valid = length - width
+        if valid > 0:
+            windows = sliding_window_view(profiles, width, axis=-1)[..., :valid, :]
+            result[..., :valid] = np.median(windows, axis=-1)
+        return result
+
+    if edge == "truncate":
+        result = np.empty_like(profiles)
+        valid = max(0, length - width + 1)
+        if valid > 0:
+            result[..., :valid] = np.median(sliding_window_view(profiles, width, axis=-1), axis=-1)
+        # only (width - 1) shrinking windows are left, each is still vectorized over the stack
+        for index in range(valid, length):
+            result[..., index] = np.median(profiles[..., index:], axis=-1)
+        return result
+
+    pad = [(0, 0)] * (profiles.ndim - 1) + [(0, width - 1)]
+    # numpy can not reflect more than (length - 1) values, so a too short profile falls back to nearest
+    if edge == "reflect" and length > width - 1:
+        padded = np.pad(profiles, pad, mode="reflect")
+    else:
+        padded = np.pad(profiles, pad, mode="edge")
+    return np.median(sliding_window_view(padded, width, axis=-1), axis=-1)
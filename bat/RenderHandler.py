@@ -0,0 +1,189 @@
+import concurrent.futures
+import logging
+import os
+import threading
+
+import numpy as np
+
+from bat.StageTimer import StageTimer
+
+
+class Renderer:
+    """
+    Renderer saves the images and the matplotlib figures of the evaluation.
+    It uses the object-oriented matplotlib Figure API with one reused Figure and Agg canvas per thread,
+    so it never touches the global pyplot state and is safe to run on background threads.
+    matplotlib and PIL are only imported by the first render, a process which renders nothing never loads them.
+    Modes:
+    "off": nothing is rendered, for headless ingest which only needs the numbers in database.
+    "sync": render in the calling thread, same as before.
+    "async": render on a thread pool fed by a bounded queue, the caller only waits when the queue is full.
+    """
+    Modes = ("off", "sync", "async")
+
+    def __init__(self, mode="sync", workers=1, queue_size=32):
+        """
+        :param mode: one of Modes
+        :param workers: the number of render threads in "async" mode
+        :param queue_size: the max number of renders waiting in "async" mode
+        """
+        if mode not in self.Modes:
+            raise ValueError("Unknown render mode: " + str(mode))
+        self.Mode = mode
+        self.Workers = workers
+        self._slots = threading.BoundedSemaphore(queue_size)
+        self._executor = None
+        self._local = threading.local()
+
+    @property
+    def Enabled(self):
+        """
+        False if nothing is rendered, so the caller can skip preparing the render input.
+        """
+        return self.Mode != "off"
+
+    def _figure(self):
+        """
+        :return: the Figure of the current thread, cleared for a new plot
+        """
+        figure = getattr(self._local, "figure", None)
+        if figure is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+            figure = Figure()
+            FigureCanvasAgg(figure)
+            self._local.figure = figure
+        figure.clear()
+        return figure
+
+    def submit(self, function, *args):
+        """
+        Run a render function according to the mode.
+        """
+        if self.Mode == "off":
+            return
+        if self.Mode == "sync":
+            self._run(function, *args)
+            return
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.Workers,
+                                                                   thread_name_prefix="Renderer")
+        self._slots.acquire()
+        future = self._executor.submit(self._run, function, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    @staticmethod
+    def _run(function, *args):
+        try:
+            with StageTimer.measure("render"):
+                function(*args)
+        except Exception as e:
+            logging.error(r"Render error: %s", e)
+
+    def close(self):
+        """
+        Wait for all submitted renders.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    @staticmethod
+    def to_8bit(display):
+        """
+        Convert a rescaled image (0~255) into an 8-bit copy, the same as PIL convert("L").
+        The copy is safe to render later, even if the rescaled image buffer is reused.
+        """
+        return np.clip(display, 0, 255).astype(np.uint8)
+
+    def save_image(self, prefix, image_8bit, profile):
+        """
+        Save the image and the plot of the integration result.
+        :param prefix: the output file name without the suffix
+        :param image_8bit: the image from to_8bit
+        :param profile: the median filter result
+        """
+        self.submit(self._save_image, prefix, image_8bit, np.array(profile))
+
+    def _save_image(self, prefix, image_8bit, profile):
+        from PIL import Image
+        Image.fromarray(image_8bit, "L").save(prefix + ".jpeg", "png")
+        figure = self._figure()
+        axes = figure.add_subplot(1, 1, 1)
+        axes.plot(profile)
+        axes.set_ylim((-5, 20))
+        axes.set_xlim((0, 250))
+        figure.savefig(prefix + "_fig.jpeg")
+
+    def save_iq(self, prefix, image_8bit, evaluation):
+        """
+        Save the plot of the ring deviation and the image with the evaluation drawn on it.
+        :param prefix: the output file name without the suffix
+        :param image_8bit: the image from to_8bit
+        :param evaluation: a dict with keys sorted_result, warning_threshold, error_threshold, min_hu, min_pos,
+        max_hu, max_dev_position, max_deviation, warning_rate, error_rate, center, radius, deviation
+        """
+        self.submit(self._save_iq, prefix, image_8bit, dict(evaluation))
+
+    def _save_iq(self, prefix, image_8bit, evaluation):
+        from PIL import Image
+        from PIL import ImageDraw
+        sorted_result = evaluation["sorted_result"]
+        result_count = len(sorted_result)
+        figure = self._figure()
+        axes = figure.add_subplot(1, 1, 1)
+        for limit in (evaluation["warning_threshold"], evaluation["warning_threshold"] * -1,
+                      evaluation["error_threshold"], evaluation["error_threshold"] * -1):
+            axes.plot([limit] * result_count)
+        axes.plot(sorted_result)
+        figure.savefig(prefix + "_IqEval_fig.jpeg")
+
+        im = Image.fromarray(image_8bit, "L").copy()
+        pixel_map = im.load()
+        draw = ImageDraw.Draw(im)
+        min_pos = evaluation["min_pos"]
+        max_dev_position = evaluation["max_dev_position"]
+        # draw the min center position, the max deviation center position and the image center position
+        for position in (min_pos, max_dev_position, evaluation["center"]):
+            for row, col in ((0, 0), (0, 1), (0, -1), (1, 0), (-1, 0)):
+                pixel_map[position[1] + col, position[0] + row] = 0
+        # Draw circle
+        radius = evaluation["radius"]
+        text_pos = evaluation["deviation"]
+        draw.ellipse((min_pos[1] - radius, min_pos[0] - radius, min_pos[1] + radius, min_pos[0] + radius))
+        draw.text((min_pos[1], min_pos[0] + text_pos), str("Middle Min HU:" + str(evaluation["min_hu"])))
+        draw.ellipse((max_dev_position[1] - radius, max_dev_position[0] - radius, max_dev_position[1] + radius,
+                      max_dev_position[0] + radius))
+        draw.text((max_dev_position[1], max_dev_position[0] + text_pos),
+                  str("Around Max HU:" + str(evaluation["max_hu"])))
+        draw.text((200, 100), str("Max HU Deviation:" + str(evaluation["max_deviation"])))
+        draw.text((200, 110), str("error rate:" + str(evaluation["error_rate"] * 100) + "%"))
+        draw.text((200, 120), str("warning rate:" + str(evaluation["warning_rate"] * 100) + "%"))
+        im.save(prefix + "_IqEval.jpeg", "png")
+
+    def save_profiles(self, output_directory, profiles, metadata):
+        """
+        Render the plots of stored integration results, e.g. from SQL3Handler.query_profiles,
+        without processing any image again.
+        :param output_directory: the folder to save the plots
+        :param profiles: a 2-D np array with one profile per row
+        :param metadata: a structured np array with at least the field uid
+        :return: the number of submitted plots
+        """
+        os.makedirs(output_directory, exist_ok=True)
+        for profile, record in zip(profiles, metadata):
+            prefix = os.path.join(output_directory, str(record["uid"]))
+            self.submit(self._save_profile, prefix, profile[~np.isnan(profile)])
+        return len(profiles)
+
+    def _save_profile(self, prefix, profile):
+        figure = self._figure()
+        axes = figure.add_subplot(1, 1, 1)
+        axes.plot(profile)
+        axes.set_ylim((-5, 20))
+        axes.set_xlim((0, 250))
+        figure.savefig(prefix + "_fig.jpeg")
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
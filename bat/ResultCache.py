@@ -0,0 +1,165 @@
+import hashlib
+import logging
+import os
+import threading
+import uuid
+import zipfile
+
+import numpy as np
+
+
+class ResultCache:
+    """
+    ResultCache keeps the results of the deterministic calculation stages on disk, e.g. the integration result
+    or the ring of ROIs of evaluate_iq. An entry is keyed by the hash of the pixel data plus the parameters
+    of its stage only, so a changed parameter recomputes only the stages which use it.
+    Each entry is one .npz file written to a temporary name and renamed, so the worker processes can share the
+    cache directory without locking. A hit touches the file, the least recently used files are removed when
+    the directory grows over Max_Size.
+    """
+    Cache_Directory = r"./BatCache/results"
+    Max_Size = 512 * 1024 * 1024
+    # the directory size is checked every Evict_Interval puts, then reduced to Evict_Ratio of Max_Size
+    Evict_Interval = 64
+    Evict_Ratio = 0.9
+
+    def __init__(self, cache_directory=None, max_size=None):
+        """
+        :param cache_directory: the folder of the cache, None to use Cache_Directory
+        :param max_size: the max total size of the cache in bytes, None to use Max_Size
+        """
+        if cache_directory is not None:
+            self.Cache_Directory = cache_directory
+        if max_size is not None:
+            self.Max_Size = max_size
+        os.makedirs(self.Cache_Directory, exist_ok=True)
+        self.Hits = 0
+        self.Misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def pixel_hash(raw_data, slope, intercept):
+        """
+        :param raw_data: the stored pixel values, e.g. DicomHandler.RawData
+        :param slope: the rescale slope
+        :param intercept: the rescale intercept
+        :return: the hex digest of the pixel buffer and the HU conversion
+        """
+        raw_data = np.ascontiguousarray(raw_data)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((raw_data.shape, raw_data.dtype.str, str(slope), str(intercept))).encode())
+        digest.update(raw_data.data)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(stage, *parameters):
+        """
+        :param stage: the stage name, e.g. "integration"
+        :param parameters: the pixel hash and the parameters of the stage, they must have a stable repr
+        :return: the key of the entry
+        """
+        digest = hashlib.blake2b(repr(parameters).encode(), digest_size=16).hexdigest()
+        return stage + "_" + digest
+
+    def _path(self, key):
+        digest = key.rsplit("_", 1)[-1]
+        return os.path.join(self.Cache_Directory, digest[:2], key + ".npz")
+
+    def get(self, key):
+        """
+        :param key: the key from key
+        :return: a dict of the stored np arrays, None if not cached
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                result = {name: entry[name] for name in entry.files}
+            os.utime(path)
+        except FileNotFoundError:
+            self.Misses += 1
+            return None
+        except (OSError, ValueError, zipfile.BadZipFile) as e:
+            logging.warning(r"Broken cache entry removed: %s %s", path, e)
+            self._remove(path)
+            self.Misses += 1
+            return None
+        self.Hits += 1
+        return result
+
+    def put(self, key, **arrays):
+        """
+        Store the arrays of an entry. An existing entry of the same key is replaced.
+        :param key: the key from key
+        :param arrays: the np arrays or scalars to store
+        """
+        path = self._path(key)
+        temporary = path + "." + uuid.uuid4().hex + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temporary, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(temporary, path)
+        except OSError as e:
+            logging.warning(r"Cache entry not stored: %s %s", path, e)
+            self._remove(temporary)
+            return
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % self.Evict_Interval == 0
+        if evict:
+            self.evict()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        :return: a list of (last used time, size, path) of every entry
+        """
+        entries = []
+        try:
+            folders = [e.path for e in os.scandir(self.Cache_Directory) if e.is_dir()]
+        except OSError:
+            return entries
+        for folder in folders:
+            try:
+                with os.scandir(folder) as files:
+                    for entry in files:
+                        if not entry.name.endswith(".npz"):
+                            continue
+                        try:
+                            stat = entry.stat()
+                        except OSError:
+                            continue
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is smaller than Evict_Ratio of Max_Size.
+        :return: the number of removed entries
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.Max_Size:
+            return 0
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.Max_Size * self.Evict_Ratio:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        logging.info(r"%d cache entries evicted.", removed)
+        return removed
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+from bat.DicomHandler import DicomHandler
+from bat.ImageHandler import ImageHandler
+from bat.IqResult import IqResult
+from bat.Pipeline import ImageResult
+from bat.ProfileFilter import median_filter
+from bat.SliceRules import SliceRules
+from bat.StageTimer import StageTimer
+from bat.Stencil import RadialProfile
+from bat.Stencil import RoiStencil
+from bat.Stencil import bresenham_ring
+from bat.Stencil import bresenham_theta
+
+
+class SeriesHandler:
+    """
+    SeriesHandler processes all slices of one Band Assessment series at once.
+    The HU images are decoded into one 3-D float32 volume kept as a memory-mapped .npy file in Cache_Directory,
+    so a series processed again, e.g. after a parameter change, reuses the volume without any dicom decode.
+    The phantom center and radius are detected once on the 1st slice, because the phantom does not move
+    during the series. The integration and the image quality evaluation run as batched operations
+    over the slice axis.
+    A loaded volume is touched, the least recently used volumes are removed when the cache grows over Max_Size.
+    """
+    Cache_Directory = r"./BatCache"
+    Max_Size = 4 * 1024 * 1024 * 1024
+    # the cache is reduced to Evict_Ratio of Max_Size
+    Evict_Ratio = 0.9
+
+    def __init__(self, slices, cache_directory=None, window=(70, -5), rules=None):
+        """
+        :param slices: a list of DicomHandler of the same series, see group_files
+        :param cache_directory: the folder of the volume cache, None to use Cache_Directory
+        :param window: the window used for the center detection as (window width, window center)
+        :param rules: the SliceRules to select the slices evaluated by evaluate_iq, None to use the default rules
+        """
+        self.Slices = sorted(slices, key=lambda s: int(s.Instance))
+        self.Rules = rules if rules is not None else SliceRules()
+        self.Key = self.series_key(self.Slices[0])
+        if cache_directory is not None:
+            self.Cache_Directory = cache_directory
+        self.Window = window
+        name = re.sub(r"[^0-9A-Za-z.-]", "_", "_".join(str(k) for k in self.Key))
+        self.Volume_File = os.path.join(self.Cache_Directory, name + ".npy")
+        self.Meta_File = os.path.join(self.Cache_Directory, name + ".json")
+        self.Center = None
+        self.Radius = None
+        self._volume = None
+
+    @staticmethod
+    def series_key(dicom_image):
+        """
+        :param dicom_image: a DicomHandler
+        :return: the key of the series as (SerialNumber, DateTime, Series)
+        """
+        return str(dicom_image.SerialNumber), str(dicom_image.DateTime), str(dicom_image.Series)
+
+    @classmethod
+    def group_files(cls, files, cache_directory=None, window=(70, -5), rules=None, index=None):
+        """
+        Group the files into series by their header only. The slices without any analysis are left out.
+        :param files: an iterable of (dicom file name, DicomMetadata or None), e.g. DirectoryHandler.iter_files()
+        :param cache_directory: the folder of the volume cache, None to use Cache_Directory
+        :param window: the window used for the center detection
+        :param rules: the SliceRules, None to use the default rules
+        :param index: the DatabaseHandler.FileIndex to index the slices skipped by the rules, None if not incremental
+        :return: a list of SeriesHandler
+        """
+        rules = rules if rules is not None else SliceRules()
+        groups = {}
+        # the series are decoded later, so a prefetched content is not kept
+        for filename, header, *_ in files:
+            dicom_image = DicomHandler(filename, header)
+            if not dicom_image.isComplete:
+                continue
+            if not rules.analyses(dicom_image):
+                if index is not None:
+                    index.mark_checked(filename)
+                continue
+            groups.setdefault(cls.series_key(dicom_image), []).append(dicom_image)
+        return [cls(slices, cache_directory, window, rules) for slices in groups.values()]
+
+    def _load_cache(self):
+        """
+        :return: True if the cached volume matches the slices of the series
+        """
+        try:
+            with open(self.Meta_File) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if meta.get("uids") != [s.Uid for s in self.Slices] or not os.path.isfile(self.Volume_File):
+            return False
+        self._volume = np.load(self.Volume_File, mmap_mode="r")
+        self.Center = tuple(meta["center"])
+        self.Radius = tuple(meta["radius"])
+        try:
+            os.utime(self.Volume_File)
+        except OSError:
+            pass
+        logging.info(r"Series volume loaded from cache: " + self.Volume_File)
+        return True
+
+    def _build_cache(self):
+        """
+        Decode every slice into the memory-mapped volume and detect the center and radius on the 1st slice.
+        """
+        os.makedirs(self.Cache_Directory, exist_ok=True)
+        first = ImageHandler(self.Slices[0].FileName, window=self.Window, header=self.Slices[0].Metadata)
+        if not first.isImageComplete:
+            raise ValueError("The 1st slice of the series can not be processed: " + str(first.FileName))
+        shape = (len(self.Slices),) + first.ImageHU.shape
+        temporary = self.Volume_File + ".tmp"
+        try:
+            volume = np.lib.format.open_memmap(temporary, mode="w+", dtype=np.float32, shape=shape)
+            volume[0] = first.ImageHU
+            for index, dicom_image in enumerate(self.Slices[1:], start=1):
+                raw_data = dicom_image.RawData
+                with StageTimer.measure("hu"):
+                    np.multiply(raw_data, float(dicom_image.Slop), out=volume[index], casting="unsafe")
+                    volume[index] += np.float32(dicom_image.Intercept)
+                # the pixel data is in the volume now, release it
+                dicom_image._raw_data = None
+            volume.flush()
+            del volume
+            os.replace(temporary, self.Volume_File)
+        except BaseException:
+            # a broken slice or a full disk must not leave the partial volume behind
+            self._remove(temporary)
+            raise
+        self.Center = tuple(int(c) for c in first.Center)
+        self.Radius = (int(first.Radius[0]), float(first.Radius[1]))
+        with open(self.Meta_File, "w") as f:
+            json.dump({"uids": [s.Uid for s in self.Slices],
+                       "center": self.Center,
+                       "radius": self.Radius}, f)
+        self._volume = np.load(self.Volume_File, mmap_mode="r")
+        logging.info(r"Series volume cached: " + self.Volume_File)
+        self.evict(self.Cache_Directory, self.Max_Size, keep=self.Volume_File)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    @classmethod
+    def evict(cls, cache_directory=None, max_size=None, keep=None):
+        """
+        Remove the least recently used volumes with their meta files until the cache is smaller than
+        Evict_Ratio of max_size. A volume already memory-mapped stays readable until it is closed.
+        :param cache_directory: the folder of the volume cache, None to use Cache_Directory
+        :param max_size: the max total size of the volumes in bytes, None to use Max_Size
+        :param keep: the volume file which is never removed, e.g. the one just built
+        :return: the number of removed volumes
+        """
+        cache_directory = cache_directory if cache_directory is not None else cls.Cache_Directory
+        max_size = max_size if max_size is not None else cls.Max_Size
+        entries = []
+        try:
+            with os.scandir(cache_directory) as files:
+                for entry in files:
+                    if not entry.name.endswith(".npy") or not entry.is_file():
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return 0
+        total = sum(size for _, size, _ in entries)
+        if total <= max_size:
+            return 0
+        removed = 0
+        keep = os.path.abspath(keep) if keep is not None else None
+        for _, size, path in sorted(entries):
+            if total <= max_size * cls.Evict_Ratio:
+                break
+            if os.path.abspath(path) == keep:
+                continue
+            cls._remove(path)
+            cls._remove(path[:-len(".npy")] + ".json")
+            total -= size
+            removed += 1
+        logging.info(r"%d series volumes evicted.", removed)
+        return removed
+
+    @property
+    def Volume(self):
+        """
+        The HU volume in shape (slice, row, col), memory-mapped from the cache.
+        """
+        if self._volume is None and not self._load_cache():
+            self._build_cache()
+        return self._volume
+
+    def integration(self, mode=None, width=None, edge=None):
+        """
+        Calculate the circular integration and the median filter of all slices at once.
+        :param mode: the RadialProfile mode, None to use ImageHandler.Integration_Mode
+        :param width: the median filter width, None to use ImageHandler.Median_Width
+        :param edge: the median filter edge mode, None to use ImageHandler.Median_Edge
+        :return: a tuple of 2 np arrays in shape (slice, radius) as (integration result, median filter result)
+        """
+        volume = self.Volume
+        profile = RadialProfile.get(self.Radius[0], mode if mode is not None else ImageHandler.Integration_Mode)
+        with StageTimer.measure("integration"):
+            integration_result = profile.integrate(volume, self.Center)
+        with StageTimer.measure("median"):
+            median_result = median_filter(integration_result,
+                                          width if width is not None else ImageHandler.Median_Width,
+                                          edge if edge is not None else ImageHandler.Median_Edge)
+        return integration_result, median_result
+
+    def evaluate_iq(self, diameter_in_mm, deviation_in_mm, indexes=None):
+        """
+        The same evaluation as ImageHandler.evaluate_iq without drawing, batched over the slices.
+        :param diameter_in_mm: the size of the ROI
+        :param deviation_in_mm: the half size of the square range to search the min HU ROI
+        :param indexes: the slice indexes to evaluate, None for all slices
+        :return: a list of IqResult, one per evaluated slice
+        """
+        volume = self.Volume
+        if indexes is None:
+            indexes = range(len(self.Slices))
+        indexes = np.asarray(indexes, dtype=np.intp)
+        if len(indexes) == 0:
+            return []
+        stack = volume[indexes]
+        radius, deviation = ImageHandler.iq_geometry(diameter_in_mm, deviation_in_mm, self.Slices[0].PixSpace)
+
+        # find the min ROI of each slice, with the same rule as ImageHandler.find_center_roi_min
+        min_hu = RoiStencil.get(10).measure(stack, [self.Center])[:, 0]
+        min_pos = np.tile(np.asarray(self.Center, dtype=np.intp), (len(indexes), 1))
+        surface = RoiStencil.get(radius).surface(stack, self.Center, deviation)
+        if surface.size > 0:
+            flat = surface.reshape(len(indexes), -1)
+            arg = np.argmin(flat, axis=1)
+            value = flat[np.arange(len(indexes)), arg]
+            better = value < min_hu
+            min_hu = np.where(better, value, min_hu)
+            offset = np.stack(np.unravel_index(arg, surface.shape[1:]), axis=1) - deviation
+            min_pos = np.where(better[:, None], min_pos + offset, min_pos)
+
+        # measure the ring of ROIs around each min position
+        ring_radius = radius * 2 + 2
+        ring_offset = bresenham_ring(ring_radius)
+        order = np.argsort(bresenham_theta(ring_radius), kind="stable")
+        ring = RoiStencil.get(radius).measure_stack(stack, min_pos[:, None, :] + ring_offset)
+        deviation_result = ring - min_hu[:, None]
+        max_index = np.argmax(deviation_result, axis=1)
+
+        results = []
+        for i in range(len(indexes)):
+            results.append(IqResult(min_hu[i], min_pos[i], ring[i].max(), min_pos[i] + ring_offset[max_index[i]],
+                                    deviation_result[i][order],
+                                    ImageHandler.Warning_Threshold, ImageHandler.Error_Threshold))
+        return results
+
+    def results(self, diameter_in_mm=100, deviation_in_mm=2):
+        """
+        Process the whole series.
+        :return: a list of Pipeline.ImageResult, one per slice
+        """
+        integration_result, median_result = self.integration()
+        iq_indexes = [i for i, s in enumerate(self.Slices) if "iq" in self.Rules.analyses(s)]
+        with StageTimer.measure("evaluate_iq"):
+            iq_results = dict(zip(iq_indexes, self.evaluate_iq(diameter_in_mm, deviation_in_mm, iq_indexes)))
+        results = []
+        for index, s in enumerate(self.Slices):
+            results.append(ImageResult(Metadata=s.Metadata,
+                                       Image_Integration_Result=integration_result[index],
+                                       Image_Median_Filter_Result=median_result[index],
+                                       IqResult=iq_results.get(index)))
+        return results
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
@@ -0,0 +1,83 @@
+import fnmatch
+import json
+import logging
+import numbers
+
+
+class SliceRules:
+    """
+    SliceRules decides which analyses run on a slice, only by its header, so a slice without any analysis
+    is never pixel decoded. The rules are checked in order and the 1st matched rule is used,
+    a slice matched by no rule is skipped.
+    A rule file is json:
+    {"rules": [
+        {"name": "IQ of Hr40f", "match": {"Kernel": "Hr40f", "OriginalCollimation": [16, 1, 32]},
+         "analyses": ["integration", "iq"]},
+        {"name": "older scanner", "match": {"Modality": "SOMATOM Def*"}, "analyses": []},
+        {"name": "all", "match": {}, "analyses": ["integration"]}
+    ]}
+    A match key is a field of DicomMetadata, e.g. Modality (the scanner model), SerialNumber, Kernel, KVP,
+    Current, OriginalCollimation, SliceThickness, TotalSlice, or SliceMode as "32x0.6".
+    The value is one value or a list of values, a string value can be a pattern like "Hr4*".
+    A processed slice is always integrated, "iq" adds ImageHandler.evaluate_iq.
+    """
+    Analyses = ("integration", "iq")
+    # the rules used before the rule file, the same as the old hard coded condition
+    Default_Rules = [{"name": "IQ of Hr40f", "match": {"Kernel": "Hr40f", "OriginalCollimation": [16, 1, 32]},
+                      "analyses": ["integration", "iq"]},
+                     {"name": "all", "match": {}, "analyses": ["integration"]}]
+
+    def __init__(self, rules=None):
+        """
+        :param rules: a list of rule dict, None to use Default_Rules
+        """
+        self.Rules = []
+        for rule in (rules if rules is not None else self.Default_Rules):
+            if not isinstance(rule.get("match", {}), dict):
+                raise ValueError("The match of a rule must be a dict: " + str(rule))
+            analyses = tuple(rule.get("analyses", ()))
+            for analysis in analyses:
+                if analysis not in self.Analyses:
+                    raise ValueError("Unknown analysis: " + str(analysis))
+            match = {key: value if isinstance(value, list) else [value]
+                     for key, value in rule.get("match", {}).items()}
+            self.Rules.append((str(rule.get("name", len(self.Rules))), match, analyses))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :param filename: the json rule file
+        :return: a SliceRules
+        """
+        with open(filename) as f:
+            return cls(json.load(f)["rules"])
+
+    @staticmethod
+    def _matches(value, expected):
+        if isinstance(expected, numbers.Number) and not isinstance(expected, bool):
+            try:
+                return float(value) == float(expected)
+            except (TypeError, ValueError):
+                return False
+        return fnmatch.fnmatchcase(str(value), str(expected))
+
+    def analyses(self, dicom_image):
+        """
+        :param dicom_image: a DicomHandler or a DicomMetadata, the header is enough
+        :return: the tuple of analyses of the 1st matched rule, empty if the slice should be skipped
+        """
+        for name, match, analyses in self.Rules:
+            try:
+                matched = all(any(self._matches(getattr(dicom_image, key), expected) for expected in values)
+                              for key, values in match.items())
+            except AttributeError as e:
+                logging.error(r"Rule %s can not be checked: %s", name, e)
+                continue
+            if matched:
+                logging.debug(r"%s matched rule %s", dicom_image.FileName, name)
+                return analyses
+        return ()
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
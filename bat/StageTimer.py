@@ -0,0 +1,123 @@
+import contextlib
+import csv
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class StageTimer:
+    """
+    StageTimer collects the time spent in each stage of the processing, e.g. "parse" or "integration".
+    It is switched off by default, then measure costs only one attribute check.
+    The samples are kept per process: the worker processes send theirs back by drain, the main process merges them.
+    """
+    Enabled = False
+    # the stages in the order of the processing, used to sort the summary table
+    Stages = ("discover", "read", "parse", "decode", "hu", "calc_circle", "integration", "median",
+              "evaluate_iq", "render", "db_insert")
+    Samples = {}
+    _lock = threading.Lock()
+    _null = contextlib.nullcontext()
+
+    @classmethod
+    def measure(cls, stage):
+        """
+        Time a block of code, e.g. "with StageTimer.measure("parse"):"
+        :param stage: the stage name
+        :return: a context manager
+        """
+        if not cls.Enabled:
+            return cls._null
+        return cls._measure(stage)
+
+    @classmethod
+    @contextlib.contextmanager
+    def _measure(cls, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.add(stage, time.perf_counter() - start)
+
+    @classmethod
+    def add(cls, stage, seconds):
+        """
+        :param stage: the stage name
+        :param seconds: the time spent once in the stage
+        """
+        with cls._lock:
+            cls.Samples.setdefault(stage, []).append(seconds)
+
+    @classmethod
+    def drain(cls):
+        """
+        Take all samples out, e.g. to send them from a worker process to the main process.
+        :return: a dict of stage name to list of seconds
+        """
+        with cls._lock:
+            samples = cls.Samples
+            cls.Samples = {}
+        return samples
+
+    @classmethod
+    def merge(cls, samples):
+        """
+        :param samples: a dict from drain
+        """
+        with cls._lock:
+            for stage, values in samples.items():
+                cls.Samples.setdefault(stage, []).extend(values)
+
+    @classmethod
+    def statistics(cls):
+        """
+        :return: a list of dict with keys stage, count, total, mean, p50, p95, max, the time in seconds
+        """
+        with cls._lock:
+            samples = {stage: np.asarray(values) for stage, values in cls.Samples.items() if values}
+        order = {stage: index for index, stage in enumerate(cls.Stages)}
+        result = []
+        for stage in sorted(samples, key=lambda s: (order.get(s, len(order)), s)):
+            values = samples[stage]
+            p50, p95 = np.percentile(values, (50, 95))
+            result.append({"stage": stage,
+                           "count": int(values.size),
+                           "total": float(values.sum()),
+                           "mean": float(values.mean()),
+                           "p50": float(p50),
+                           "p95": float(p95),
+                           "max": float(values.max())})
+        return result
+
+    @classmethod
+    def summary(cls):
+        """
+        :return: the statistics as a text table, the time in milliseconds except total in seconds
+        """
+        lines = [f"{'stage':<12}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for row in cls.statistics():
+            lines.append(f"{row['stage']:<12}{row['count']:>8d}{row['total']:>10.2f}{row['mean'] * 1000:>10.2f}"
+                         f"{row['p50'] * 1000:>10.2f}{row['p95'] * 1000:>10.2f}{row['max'] * 1000:>10.2f}")
+        return "\n".join(lines)
+
+    @classmethod
+    def export(cls, filename):
+        """
+        Save the statistics as csv if the file name ends with .csv, otherwise as json.
+        :param filename: the output file name
+        """
+        rows = cls.statistics()
+        if filename.lower().endswith(".csv"):
+            with open(filename, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=["stage", "count", "total", "mean", "p50", "p95", "max"])
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(filename, "w") as f:
+                json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    print("please do not use it individually unless of debugging.")
@@ -0,0 +1,237 @@
+import functools
+import logging
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=None)
+def bresenham_ring(radius: int):
+    """
+    Get the pixel offsets visited by ImageHandler.bresenham for one radius.
+    The order is exactly the order used by the pure python loop, including the duplicated
+    points on the axis, so any sum built from these offsets is the same as the loop result.
+    :param radius: the radius of the circle in PIXEL
+    :return: a read-only int array in shape (count, 2) as (row offset, col offset)
+    """
+    x = 0
+    y = radius
+    d = 3 - 2 * radius
+    offsets = []
+    while x < y:
+        offsets.extend(((-y, x), (y, x), (-y, -x), (y, -x),
+                        (-x, y), (-x, -y), (x, y), (x, -y)))
+        if d < 0:
+            d = d + 4 * x + 6
+        else:
+            d = d + 4 * (x - y) + 10
+            y -= 1
+        x += 1
+    result = np.array(offsets, dtype=np.intp).reshape(-1, 2)
+    result.flags.writeable = False
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def bresenham_theta(radius: int):
+    """
+    Get the angle of each point of bresenham_ring(radius) in the same integer degree
+    convention which ImageHandler.evaluate_iq used to sort the ring result.
+    :param radius: the radius of the circle in PIXEL
+    :return: a read-only int array in shape (count,) of the angle in degree
+    """
+    ring = bresenham_ring(radius)
+    y = -ring[:, 0]
+    x = ring[:, 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        angle = np.degrees(np.arctan(y / x))
+    theta = np.select(
+        [x == 0,
+         y == 0,
+         (x > 0) & (y > 0),
+         (x < 0) & (y > 0),
+         (x < 0) & (y < 0)],
+        [np.where(y > 0, 90, 270),
+         np.where(x > 0, 0, 180),
+         angle,
+         angle * -1 + 90,
+         angle + 180],
+        default=angle * -1 + 270)
+    result = np.trunc(theta).astype(np.intp)
+    result.flags.writeable = False
+    return result
+
+
+class RadialProfile:
+    """
+    RadialProfile pre-computes the sampling geometry of the circular integration once per
+    (radius, mode) and reduces an image to its radial profile in a single pass.
+    The geometry is kept as offsets to the center, so one cached geometry serves every center.
+    Two modes are supported:
+    "bresenham": sample exactly the same pixels as the ImageHandler.bresenham loop.
+    The result is identical to the values already stored in the database.
+    "radius": every pixel inside the radius contributes to the ring of its rounded distance to center.
+    """
+    Modes = ("bresenham", "radius")
+    Cache = {}
+
+    def __init__(self, radius: int, mode="bresenham"):
+        """
+        :param radius: the number of rings, ring 0 is not calculated and always 0
+        :param mode: "bresenham" or "radius"
+        """
+        if mode not in self.Modes:
+            raise ValueError("Unknown radial profile mode: " + str(mode))
+        self.Radius = int(radius)
+        self.Mode = mode
+        if mode == "bresenham":
+            rows, cols, labels = self._bresenham_geometry()
+        else:
+            rows, cols, labels = self._radius_geometry()
+        # the offsets to the center as (row offset, col offset) of each sampled pixel
+        self.Rows = rows
+        self.Cols = cols
+        self.Labels = labels
+        self.Counts = np.bincount(labels, minlength=self.Radius)
+        # ring 0 is never sampled, avoid the division by zero
+        self.Counts[self.Counts == 0] = 1
+
+    def _bresenham_geometry(self):
+        rows = []
+        cols = []
+        labels = []
+        for index in range(1, self.Radius):
+            ring = bresenham_ring(index)
+            rows.append(ring[:, 0])
+            cols.append(ring[:, 1])
+            labels.append(np.full(len(ring), index, dtype=np.intp))
+        if not labels:
+            empty = np.zeros(0, dtype=np.intp)
+            return empty, empty, empty
+        return np.concatenate(rows), np.concatenate(cols), np.concatenate(labels)
+
+    def _radius_geometry(self):
+        offset = np.arange(-self.Radius, self.Radius + 1, dtype=np.intp)
+        rows, cols = np.meshgrid(offset, offset, indexing="ij")
+        labels = np.rint(np.hypot(rows, cols)).astype(np.intp)
+        inside = (labels >= 1) & (labels < self.Radius)
+        return rows[inside], cols[inside], labels[inside]
+
+    @classmethod
+    def get(cls, radius: int, mode="bresenham"):
+        """
+        Get the cached geometry for (radius, mode), create it if not existing.
+        """
+        key = (int(radius), mode)
+        profile = cls.Cache.get(key)
+        if profile is None:
+            profile = cls(radius, mode)
+            cls.Cache[key] = profile
+            logging.debug(r"Radial profile geometry created for: %s", key)
+        return profile
+
+    def integrate(self, image, center: tuple):
+        """
+        Calculate the mean value of each ring.
+        :param image: a np array in shape (row, col) or a stack of images in shape (..., row, col)
+        :param center: a tuple to indicate center as (row, col)
+        :return: a np array in shape (..., radius) of the mean value of each ring
+        """
+        image = np.asarray(image)
+        values = image[..., self.Rows + int(center[0]), self.Cols + int(center[1])]
+        if values.ndim == 1:
+            sums = np.bincount(self.Labels, weights=values, minlength=self.Radius)
+            return sums / self.Counts
+        # flatten the leading axes and shift the labels so one bincount handles the whole stack
+        stack = values.reshape(-1, values.shape[-1])
+        shift = np.arange(len(stack), dtype=np.intp)[:, None] * self.Radius
+        sums = np.bincount((self.Labels + shift).ravel(), weights=stack.ravel(),
+                           minlength=len(stack) * self.Radius)
+        return (sums.reshape(len(stack), self.Radius) / self.Counts).reshape(
+            values.shape[:-1] + (self.Radius,))
+
+
+class RoiStencil:
+    """
+    RoiStencil is the circular ROI of ImageHandler.roi_measure as a fixed list of pixel offsets.
+    Each offset is weighted by how many times the bresenham rings 1 ~ radius-1 visit it,
+    so the weighted mean is the same value as the ring by ring loop.
+    The ROI mean of many centers is then calculated by one fancy indexing gather.
+    """
+    Cache = {}
+    # max number of gathered pixels in one chunk to keep the memory bounded
+    Chunk_Size = 1 << 22
+
+    def __init__(self, radius: int):
+        """
+        :param radius: the radius of the ROI in PIXEL
+        """
+        self.Radius = int(radius)
+        if self.Radius < 2:
+            raise ValueError("ROI radius should be at least 2 pixels, got: " + str(radius))
+        rings = np.concatenate([bresenham_ring(index) for index in range(1, self.Radius)])
+        offsets, weights = np.unique(rings, axis=0, return_counts=True)
+        self.Rows = offsets[:, 0]
+        self.Cols = offsets[:, 1]
+        self.Weights = weights.astype(np.float64)
+        self.Total = float(weights.sum())
+
+    @classmethod
+    def get(cls, radius: int):
+        """
+        Get the cached stencil for the radius, create it if not existing.
+        """
+        radius = int(radius)
+        stencil = cls.Cache.get(radius)
+        if stencil is None:
+            stencil = cls(radius)
+            cls.Cache[radius] = stencil
+            logging.debug(r"ROI stencil created for radius: %s", radius)
+        return stencil
+
+    def measure(self, image, centers):
+        """
+        Measure the mean value of the ROI at each center.
+        :param image: a np array in shape (row, col) or a stack of images in shape (..., row, col)
+        :param centers: an array like in shape (n, 2) as (row, col) of each ROI center
+        :return: a np array in shape (..., n) of the ROI mean values
+        """
+        image = np.asarray(image)
+        centers = np.asarray(centers, dtype=np.intp).reshape(-1, 2)
+        step = max(1, self.Chunk_Size // (len(self.Weights) * max(1, image[..., 0, 0].size)))
+        result = []
+        for start in range(0, len(centers), step):
+            chunk = centers[start:start + step]
+            rows = chunk[:, 0:1] + self.Rows
+            cols = chunk[:, 1:2] + self.Cols
+            result.append(image[..., rows, cols] @ self.Weights)
+        if not result:
+            return np.zeros(image.shape[:-2] + (0,))
+        return np.concatenate(result, axis=-1) / self.Total
+
+    def measure_stack(self, images, centers):
+        """
+        Measure the ROI mean of each image of a stack at its own centers.
+        :param images: a stack of images in shape (count, row, col)
+        :param centers: an array like in shape (count, n, 2) as (row, col) of the ROI centers of each image
+        :return: a np array in shape (count, n) of the ROI mean values
+        """
+        centers = np.asarray(centers, dtype=np.intp)
+        index = np.arange(len(centers), dtype=np.intp)[:, None, None]
+        rows = centers[:, :, 0:1] + self.Rows
+        cols = centers[:, :, 1:2] + self.Cols
+        return (images[index, rows, cols] @ self.Weights) / self.Total
+
+    def surface(self, image, center: tuple, deviation: int):
+        """
+        Measure the ROI mean at every position of the square search window
+        [center - deviation, center + deviation) in both row and col.
+        :param image: a np array in shape (row, col) or a stack of images in shape (..., row, col)
+        :param center: the center of the search window as (row, col)
+        :param deviation: the half size of the search window in PIXEL
+        :return: a np array in shape (..., 2 * deviation, 2 * deviation),
+        element [i, j] is the ROI mean at (center row - deviation + i, center col - deviation + j)
+        """
+        offset = np.arange(-deviation, deviation, dtype=np.intp)
+        rows, cols = np.meshgrid(offset + int(center[0]), offset + int(center[1]), indexing="ij")
+        result = self.measure(image, np.stack((rows.ravel(), cols.ravel()), axis=1))
+        return result.reshape(result.shape[:-1] + rows.shape)
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# run as "python benchmarks/BatBenchmark.py" from the repository root
+Repository_Root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, Repository_Root)
+
+from bat.DatabaseHandler import SQL3Writer
+from bat.DicomHandler import DicomHandler
+from bat.DirectoryHandler import DirectoryHandler
+from bat.ImageHandler import ImageHandler
+from bat.PhantomGenerator import phantom_hu
+from bat.PhantomGenerator import write_phantom
+from bat.Pipeline import process_file
+from bat.RenderHandler import Renderer
+
+# The synthetic phantoms, the keyword arguments of phantom_hu.
+# The profiles of these phantoms are pinned by Golden_Profiles, they must not change between runs.
+Phantoms = {
+    "clean": {},
+    "noise": {"noise": 5.0, "seed": 1},
+    "ring": {"rings": ((60, 8.0, 1.0), (150, -6.0, 1.0)), "noise": 3.0, "seed": 2},
+    "band": {"rings": ((100, 4.0, 8.0),), "noise": 3.0, "seed": 3},
+    "offset": {"center_offset": (6, -4), "rings": ((80, 5.0, 2.0),), "noise": 3.0, "seed": 4},
+}
+# The results of the pre-vectorization loops (center fixed at (256, 256), median filter leaving the last 8 values
+# as 0, the numbers of the old evaluate_iq(100, 2)) on Phantoms. They do not depend on the machine, so they are
+# committed, while the timing baseline is machine local.
+Golden_Profiles = os.path.join(Repository_Root, "benchmarks", "GoldenProfiles.json")
+# the relative slow down of a timing to the baseline reported as regression
+Timing_Tolerance = 0.25
+# the max absolute difference of a profile value to the golden profile reported as regression
+Profile_Tolerance = 1e-9
+# the modules whose import time is measured in a fresh interpreter
+Startup_Modules = ("bat.DatabaseHandler", "bat.Pipeline", "BatPlus")
+# the plotting modules must only be loaded by the first render, never by an import
+Heavy_Modules = ("matplotlib", "PIL")
+
+
+def generate_archive(directory, size, files_per_folder=50):
+    """
+    Write size phantom files into the directory, cycling through Phantoms, one sub folder per files_per_folder.
+    :return: the list of file names
+    """
+    names = sorted(Phantoms)
+    images = {name: phantom_hu(**Phantoms[name]) for name in names}
+    files = []
+    for index in range(size):
+        folder = os.path.join(directory, f"{index // files_per_folder:04d}")
+        os.makedirs(folder, exist_ok=True)
+        name = names[index % len(names)]
+        files.append(write_phantom(os.path.join(folder, f"{index:06d}_{name}.dcm"), images[name],
+                                   instance=index + 1))
+    return files
+
+
+def time_call(function, repeat):
+    """
+    :return: a list of the seconds of each call
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def golden_checks(work_directory, golden_file=Golden_Profiles, tolerance=Profile_Tolerance):
+    """
+    Calculate every phantom of the golden file by the current engines in the same condition as the old loops:
+    the golden center and the "zero" median edge. The results must be the same as the golden values.
+    :return: a list of the failed check messages
+    """
+    with open(golden_file) as f:
+        golden = json.load(f)
+    failed = []
+    median_edge = ImageHandler.Median_Edge
+    ImageHandler.Median_Edge = "zero"
+    try:
+        for name, expected in sorted(golden.items()):
+            filename = write_phantom(os.path.join(work_directory, name + ".dcm"), phantom_hu(**Phantoms[name]))
+            image = ImageHandler(filename, window=(70, -5))
+            if not image.isImageComplete:
+                failed.append(f"golden {name}: the phantom is not processed")
+                continue
+            image.Center = tuple(expected["center"])
+            image.integration()
+            actual = {"integration": image.Image_Integration_Result, "median": image.Image_Median_Filter_Result}
+            actual.update(image.evaluate_iq(100, 2).as_dict())
+            for key in ("integration", "median"):
+                a = np.asarray(actual[key])
+                e = np.asarray(expected[key])
+                if a.shape != e.shape:
+                    failed.append(f"golden {name} {key}: length {a.size:d} instead of {e.size:d}")
+                elif not np.allclose(a, e, rtol=0, atol=tolerance):
+                    failed.append(f"golden {name} {key}: max difference {np.max(np.abs(a - e)):g}")
+            for key, value in expected["iq"].items():
+                if not np.allclose(actual[key], value, rtol=0, atol=tolerance):
+                    failed.append(f"golden {name} iq {key}: {actual[key]} instead of {value}")
+    finally:
+        ImageHandler.Median_Edge = median_edge
+    return failed
+
+
+def image_benchmarks(work_directory, repeat):
+    """
+    Time the calculation of one image.
+    :return: the timings
+    """
+    timings = {}
+    filename = write_phantom(os.path.join(work_directory, "ring.dcm"), phantom_hu(**Phantoms["ring"]))
+    # the whole processing of one file is still checked to run
+    process_file(filename)
+    image = ImageHandler(filename, window=(70, -5))
+    radius, deviation = image.iq_geometry(100, 2, image.PixSpace)
+    cases = {"integration": image.integration,
+             "find_center_roi_min": lambda: image.find_center_roi_min(radius, deviation),
+             "circular_bresenham": lambda: image.circular_bresenham(image.Center, radius * 2 + 2, radius),
+             "evaluate_iq": lambda: image.evaluate_iq(100, 2)}
+    for case, function in cases.items():
+        timings[case] = time_call(function, repeat)
+    return timings
+
+
+def startup_benchmarks(repeat):
+    """
+    Time the import of Startup_Modules, each in a fresh interpreter as a worker process or a short job starts.
+    :return: a tuple as (timings, a list of the failed check messages)
+    """
+    timings = {}
+    failed = []
+    script = ("import sys, time; start = time.perf_counter(); import {0}; seconds = time.perf_counter() - start; "
+              "print(seconds); print(' '.join(m for m in {1!r} if m in sys.modules))")
+    for module in Startup_Modules:
+        seconds = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", script.format(module, Heavy_Modules)], cwd=Repository_Root,
+                                    check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout.splitlines()
+            seconds.append(float(output[0]))
+        timings["import_" + module] = seconds
+        loaded = output[1].split() if len(output) > 1 else ()
+        failed.extend(f"startup {module}: {m} is loaded at import" for m in loaded)
+    return timings, failed
+
+
+def pixel_checks(work_directory):
+    """
+    Check that the pixel data of a phantom file is memory mapped, not decoded, and equal to the decoded pixels.
+    :return: a list of the failed check messages
+    """
+    filename = write_phantom(os.path.join(work_directory, "mmap.dcm"), phantom_hu(**Phantoms["noise"]))
+    mapped = DicomHandler.map_pixels(filename)
+    if mapped is None:
+        return ["mmap: the phantom file is not memory mapped"]
+    decoded = DicomHandler(filename).RawData
+    if mapped.dtype != decoded.dtype or not np.array_equal(mapped, decoded):
+        return ["mmap: the mapped pixels differ from the decoded pixels"]
+    return []
+
+
+def archive_benchmarks(work_directory, sizes, repeat):
+    """
+    Time the discovery and the database insert of archives in several sizes.
+    :return: the timings
+    """
+    timings = {}
+    template = process_file(write_phantom(os.path.join(work_directory, "template.dcm"),
+                                          phantom_hu(**Phantoms["ring"])))
+    for size in sizes:
+        directory = os.path.join(work_directory, f"archive_{size:d}")
+        generate_archive(directory, size)
+        timings[f"discover_{size:d}"] = time_call(lambda: DirectoryHandler(directory).list_files(), repeat)
+
+        results = [template._replace(Metadata=template.Metadata._replace(Uid=template.Metadata.Uid + f"_{index:d}"))
+                   for index in range(size)]
+
+        def insert():
+            database_name = os.path.join(work_directory, f"insert_{size:d}.db")
+            if os.path.exists(database_name):
+                os.remove(database_name)
+            with SQL3Writer(database_name) as writer:
+                writer.write_many(results)
+        timings[f"db_insert_{size:d}"] = time_call(insert, repeat)
+    return timings
+
+
+def run_benchmarks(sizes=(10, 100), repeat=5, work_directory=None):
+    """
+    :param sizes: the archive sizes of the discovery and insert benchmarks
+    :param repeat: the number of calls of each timing
+    :param work_directory: the folder of the generated files, None to use a temporary folder
+    :return: a dict as {"timings": {case: {"min", "median", "max"}}, "failed_checks": [...]}
+    """
+    temporary = work_directory is None
+    if temporary:
+        work_directory = tempfile.mkdtemp(prefix="BatBenchmark")
+    os.makedirs(work_directory, exist_ok=True)
+    render = ImageHandler.Render
+    ImageHandler.Render = Renderer("off")
+    try:
+        timings = image_benchmarks(work_directory, repeat)
+        timings.update(archive_benchmarks(work_directory, sizes, repeat))
+        startup_timings, failed_checks = startup_benchmarks(repeat)
+        timings.update(startup_timings)
+        failed_checks.extend(pixel_checks(work_directory))
+        failed_checks.extend(golden_checks(work_directory))
+    finally:
+        ImageHandler.Render = render
+        if temporary:
+            shutil.rmtree(work_directory, ignore_errors=True)
+    return {"timings": {case: {"min": float(np.min(s)), "median": float(np.median(s)), "max": float(np.max(s))}
+                        for case, s in timings.items()},
+            "failed_checks": failed_checks}
+
+
+def compare(result, baseline, timing_tolerance=Timing_Tolerance):
+    """
+    Compare the timings with the machine local baseline, the profiles are checked by golden_checks.
+    :return: a list of the regression messages, empty if nothing regressed
+    """
+    messages = []
+    for case, expected in baseline.get("timings", {}).items():
+        actual = result["timings"].get(case)
+        if actual is not None and actual["median"] > expected["median"] * (1 + timing_tolerance):
+            messages.append(f"timing {case}: {actual['median'] * 1000:.2f}ms instead of "
+                            f"{expected['median'] * 1000:.2f}ms")
+    return messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Band Assessment benchmark on synthetic phantoms.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100],
+                        help="the archive sizes of the discovery and insert benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="the number of calls of each timing")
+    parser.add_argument("--work-dir", help="keep the generated files in this folder")
+    parser.add_argument("--baseline", help="compare with the baseline json, exit with 1 on regression")
+    parser.add_argument("--save-baseline", help="save the result as the baseline json")
+    parser.add_argument("--timing-tolerance", type=float, default=Timing_Tolerance,
+                        help="the relative slow down reported as regression")
+    args = parser.parse_args(argv)
+
+    result = run_benchmarks(args.sizes, args.repeat, args.work_dir)
+    print(f"{'case':<24}{'min ms':>10}{'median ms':>12}{'max ms':>10}")
+    for case, timing in result["timings"].items():
+        print(f"{case:<24}{timing['min'] * 1000:>10.2f}{timing['median'] * 1000:>12.2f}{timing['max'] * 1000:>10.2f}")
+    for message in result["failed_checks"]:
+        print("FAILED " + message)
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=1)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            messages = compare(result, json.load(f), args.timing_tolerance)
+        for message in messages:
+            print("REGRESSION " + message)
+        if messages:
+            return 1
+        print("No regression to the baseline.")
+    return 1 if result["failed_checks"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())